@@ -0,0 +1,182 @@
+# audio.py
+# Audio conversion helpers shared by the relay and the transcoding workers
+import io
+import wave
+import base64
+import struct
+import numpy as np
+from pydub import AudioSegment  # For audio processing
+
+# Format expected by the OpenAI Realtime API for input_audio_buffer.append
+TARGET_SAMPLE_RATE = 24000
+TARGET_CHANNELS = 1
+
+
+def process_audio(raw_audio):
+    # Convert audio to 16-bit PCM, 24kHz, mono, little-endian
+    audio = AudioSegment.from_file(io.BytesIO(raw_audio))
+    audio = audio.set_frame_rate(24000).set_channels(1).set_sample_width(2)
+    pcm_audio = audio.raw_data
+
+    # Encode to base64
+    base64_audio = base64.b64encode(pcm_audio).decode('utf-8')
+    return base64_audio
+
+# Range accepted for negotiated PCM16 input
+MIN_INPUT_SAMPLE_RATE = 8000
+MAX_INPUT_SAMPLE_RATE = 192000
+MAX_INPUT_CHANNELS = 8
+# Formats that can be streamed in small frames: each frame is decoded on its own without ffmpeg
+STREAM_INPUT_FORMATS = ("pcm16", "wav")
+
+
+def audio_input_from_query(query_params):
+    # Input audio settings negotiated on connect; raises ValueError with a message for the client
+    try:
+        sample_rate = int(query_params.get("sample_rate", TARGET_SAMPLE_RATE))
+        channels = int(query_params.get("channels", TARGET_CHANNELS))
+    except ValueError:
+        raise ValueError("sample_rate and channels must be integers.") from None
+    if not MIN_INPUT_SAMPLE_RATE <= sample_rate <= MAX_INPUT_SAMPLE_RATE:
+        raise ValueError(f"sample_rate must be between {MIN_INPUT_SAMPLE_RATE} and {MAX_INPUT_SAMPLE_RATE}.")
+    if not 1 <= channels <= MAX_INPUT_CHANNELS:
+        raise ValueError(f"channels must be between 1 and {MAX_INPUT_CHANNELS}.")
+    input_format = query_params.get("input_format")
+    mode = query_params.get("input_mode", "blob")
+    if mode == "stream" and input_format not in STREAM_INPUT_FORMATS:
+        # Compressed fragments would each go through ffmpeg, and all but the first lack a container header
+        raise ValueError("input_mode=stream requires input_format=pcm16 or input_format=wav.")
+    return {
+        "format": input_format,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        # "stream" sends small continuous frames that are appended as they arrive
+        "mode": mode,
+    }
+
+def detect_audio_format(raw_audio):
+    # Sniff the container from its magic bytes; raw PCM has no header and must be negotiated
+    header = bytes(raw_audio[:12])
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return "wav"
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return "webm"
+    if header[:4] == b'OggS':
+        return "ogg"
+    if header[:3] == b'ID3' or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return None
+
+def parse_wav(raw_audio):
+    # Walk the RIFF chunks and return (sample_rate, channels, sample_width, data) for PCM WAV files.
+    # data is a memoryview into raw_audio so no samples are copied. Returns None for anything
+    # the fast path cannot handle (compressed WAV, float samples, truncated headers).
+    view = memoryview(raw_audio)
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        chunk_size = struct.unpack_from('<I', view, offset + 4)[0]
+        body_start = offset + 8
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            if len(view) < body_start + 16:
+                return None
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from('<HHIIHH', view, body_start)
+            fmt = (audio_format, channels, sample_rate, bits // 8)
+        elif chunk_id == b'data':
+            if fmt is None or fmt[0] != 1 or not fmt[1] or not fmt[2]:  # 1 == integer PCM
+                return None
+            # Streaming writers often leave the data size at 0 or 0xFFFFFFFF, so clamp to what we have
+            data = view[body_start:min(body_start + chunk_size, len(view))] if chunk_size else view[body_start:]
+            return fmt[2], fmt[1], fmt[3], data
+        offset = body_start + chunk_size + (chunk_size & 1)  # chunks are word aligned
+    return None
+
+def convert_pcm16(pcm_data, sample_rate, channels):
+    # Bring little-endian PCM16 to 24kHz mono. Compliant input is returned as-is (no copy);
+    # otherwise downmix and resample with NumPy instead of spawning ffmpeg.
+    frame_size = 2 * channels
+    pcm_data = memoryview(pcm_data)[:len(pcm_data) - len(pcm_data) % frame_size]
+    if sample_rate == TARGET_SAMPLE_RATE and channels == TARGET_CHANNELS:
+        return pcm_data
+
+    samples = np.frombuffer(pcm_data, dtype='<i2')
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    else:
+        samples = samples.astype(np.float32)
+
+    if sample_rate > TARGET_SAMPLE_RATE and len(samples):
+        samples = _anti_alias(samples, sample_rate)
+        if sample_rate % TARGET_SAMPLE_RATE == 0:
+            # Integer ratios (48kHz, 96kHz) just keep every n-th filtered sample
+            samples = samples[::sample_rate // TARGET_SAMPLE_RATE]
+            sample_rate = TARGET_SAMPLE_RATE
+
+    if sample_rate != TARGET_SAMPLE_RATE and len(samples):
+        target_length = int(round(len(samples) * TARGET_SAMPLE_RATE / sample_rate))
+        positions = np.arange(target_length) * (sample_rate / TARGET_SAMPLE_RATE)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+
+    return np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+
+def _anti_alias(samples, sample_rate, taps=63):
+    # Low-pass below the target Nyquist frequency before downsampling, or content above it folds
+    # back as aliasing (a windowed-sinc FIR filter, about 3 ms of CPU per second of 48kHz audio)
+    cutoff = 0.45 * TARGET_SAMPLE_RATE / sample_rate  # in cycles per input sample, with a little headroom
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    kernel /= kernel.sum()
+    # Edge padding keeps frame boundaries from being pulled towards zero
+    padded = np.pad(samples, (taps // 2, taps // 2), mode='edge')
+    return np.convolve(padded, kernel, mode='valid')
+
+def fast_path_pcm(raw_audio, declared_format=None, sample_rate=TARGET_SAMPLE_RATE, channels=TARGET_CHANNELS):
+    # 24kHz mono PCM16 for input that does not need pydub/ffmpeg, or None to fall back to process_audio.
+    # declared_format is what the client negotiated on connect ("pcm16" for headerless samples).
+    detected = detect_audio_format(raw_audio)
+    if detected == "wav":
+        parsed = parse_wav(raw_audio)
+        if parsed is None:
+            return None
+        wav_rate, wav_channels, sample_width, data = parsed
+        if sample_width != 2:
+            return None
+        return convert_pcm16(data, wav_rate, wav_channels)
+    if declared_format == "pcm16":
+        # Headerless samples can look like an MP3 sync word, so trust the negotiated format
+        return convert_pcm16(raw_audio, sample_rate, channels)
+    return None
+
+def pcm_to_wav(pcm_data):
+    # Define WAV file parameters
+    num_channels = 1
+    sample_width = 2  # 16-bit audio
+    frame_rate = 24000  # 24kHz
+
+    # Create a BytesIO object to hold WAV data
+    wav_io = io.BytesIO()
+
+    # Initialize WAV writer
+    with wave.open(wav_io, 'wb') as wav_file:
+        wav_file.setnchannels(num_channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes(pcm_data)
+
+    # Get WAV data from BytesIO object
+    wav_data = wav_io.getvalue()
+    return wav_data
+
+
+# Header of a streamed audio frame: big-endian uint32 sequence number
+AUDIO_FRAME_HEADER = struct.Struct('>I')
+
+def frame_audio_chunk(seq, pcm_data, stream_format="pcm16"):
+    # Prefix a chunk of assistant audio with its sequence number.
+    # "pcm16" sends the raw samples, "wav" wraps each chunk in a small standalone WAV segment
+    if stream_format == "wav":
+        payload = pcm_to_wav(pcm_data)
+    else:
+        payload = pcm_data
+    return AUDIO_FRAME_HEADER.pack(seq) + payload
@@ -0,0 +1,201 @@
+# config.py
+# Loads config.json, turns every organization into an immutable, validated session template
+# and hot-reloads the file when it changes on disk
+import os
+import json
+import asyncio
+import logging
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+
+
+class ConfigError(ValueError):
+    """Raised when config.json is missing required settings or has invalid values."""
+
+
+def freeze(value):
+    # Read-only view of parsed JSON so a session can never mutate the shared template
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+@dataclass(frozen=True)
+class OrganizationConfig:
+    name: str
+    settings: Mapping     # the organization's entry in config.json (read-only)
+    session_update: str   # serialized session.update event sent to OpenAI on connect
+
+
+def build_session(org_config):
+    # Build session configuration based on org_config
+    return {
+        "voice": org_config.get("voice", "alloy"),
+        "instructions": org_config["prompts"]["instructions"],
+        "turn_detection": org_config.get("turn_detection"),
+        "input_audio_format": org_config.get("input_audio_format", "pcm16"),
+        "output_audio_format": org_config.get("output_audio_format", "pcm16"),
+        "input_audio_transcription": org_config.get("input_audio_transcription", {"model": "whisper-1"}),
+        "temperature": org_config.get("temperature", 0.8),
+        "tool_choice": org_config.get("tool_choice", "auto"),
+        "tools": org_config.get("tools", []),
+        "max_response_output_tokens": org_config.get("max_response_output_tokens", "inf")
+    }
+
+
+AUDIO_FORMATS = ("pcm16", "g711_ulaw", "g711_alaw")
+TOOL_CHOICES = ("auto", "none", "required")
+
+
+def validate_tool(org_name, tool):
+    if not isinstance(tool, dict) or tool.get("type") != "function":
+        raise ConfigError(f"Organization '{org_name}': every tool must be an object with type 'function'.")
+    if not isinstance(tool.get("name"), str) or not tool["name"]:
+        raise ConfigError(f"Organization '{org_name}': tool is missing a name.")
+    parameters = tool.get("parameters", {"type": "object"})
+    if not isinstance(parameters, dict) or parameters.get("type") != "object":
+        raise ConfigError(f"Organization '{org_name}': parameters of tool '{tool['name']}' must be a JSON schema object.")
+    properties = parameters.get("properties", {})
+    for required in parameters.get("required", []):
+        if required not in properties:
+            raise ConfigError(
+                f"Organization '{org_name}': tool '{tool['name']}' requires unknown parameter '{required}'."
+            )
+
+
+def validate_organization(name, org_config):
+    if not isinstance(org_config, dict):
+        raise ConfigError(f"Organization '{name}' must be an object.")
+    prompts = org_config.get("prompts")
+    if not isinstance(prompts, dict) or not isinstance(prompts.get("instructions"), str):
+        raise ConfigError(f"Organization '{name}' is missing prompts.instructions.")
+    for key in ("input_audio_format", "output_audio_format"):
+        if org_config.get(key, "pcm16") not in AUDIO_FORMATS:
+            raise ConfigError(f"Organization '{name}': {key} must be one of {', '.join(AUDIO_FORMATS)}.")
+    temperature = org_config.get("temperature", 0.8)
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)):
+        raise ConfigError(f"Organization '{name}': temperature must be a number.")
+    max_tokens = org_config.get("max_response_output_tokens", "inf")
+    if max_tokens != "inf" and (isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1):
+        raise ConfigError(f"Organization '{name}': max_response_output_tokens must be a positive integer or 'inf'.")
+    turn_detection = org_config.get("turn_detection")
+    if turn_detection is not None and not isinstance(turn_detection, dict):
+        raise ConfigError(f"Organization '{name}': turn_detection must be null or an object.")
+    if org_config.get("audio_output_mode", "wav") not in ("wav", "stream"):
+        raise ConfigError(f"Organization '{name}': audio_output_mode must be 'wav' or 'stream'.")
+    if org_config.get("audio_stream_format", "pcm16") not in ("pcm16", "wav"):
+        raise ConfigError(f"Organization '{name}': audio_stream_format must be 'pcm16' or 'wav'.")
+
+    for key in ("history_max_messages", "history_max_bytes"):
+        value = org_config.get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise ConfigError(f"Organization '{name}': {key} must be a non-negative integer (0 for no cap).")
+    if not isinstance(org_config.get("record_sessions", False), bool):
+        raise ConfigError(f"Organization '{name}': record_sessions must be true or false.")
+    compress_min_bytes = org_config.get("client_compress_min_bytes", 0)
+    if isinstance(compress_min_bytes, bool) or not isinstance(compress_min_bytes, int) or compress_min_bytes < 0:
+        raise ConfigError(f"Organization '{name}': client_compress_min_bytes must be a non-negative integer (0 disables).")
+
+    input_vad = org_config.get("input_vad", {})
+    if not isinstance(input_vad, dict):
+        raise ConfigError(f"Organization '{name}': input_vad must be an object.")
+    batch_ms = org_config.get("input_append_batch_ms", 100)
+    if isinstance(batch_ms, bool) or not isinstance(batch_ms, (int, float)) or batch_ms <= 0:
+        raise ConfigError(f"Organization '{name}': input_append_batch_ms must be a positive number.")
+
+    tools = org_config.get("tools", [])
+    if not isinstance(tools, list):
+        raise ConfigError(f"Organization '{name}': tools must be a list.")
+    tool_names = set()
+    for tool in tools:
+        validate_tool(name, tool)
+        if tool["name"] in tool_names:
+            raise ConfigError(f"Organization '{name}': tool '{tool['name']}' is defined twice.")
+        tool_names.add(tool["name"])
+    tool_settings = org_config.get("tool_settings", {})
+    if not isinstance(tool_settings, dict):
+        raise ConfigError(f"Organization '{name}': tool_settings must be an object keyed by tool name.")
+    for tool_name, settings in tool_settings.items():
+        if tool_name not in tool_names:
+            raise ConfigError(f"Organization '{name}': tool_settings refers to unknown tool '{tool_name}'.")
+        if not isinstance(settings, dict):
+            raise ConfigError(f"Organization '{name}': tool_settings.{tool_name} must be an object.")
+        timeout = settings.get("timeout", 1)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ConfigError(f"Organization '{name}': tool_settings.{tool_name}.timeout must be a positive number.")
+        cache_ttl = settings.get("cache_ttl", 0)
+        if isinstance(cache_ttl, bool) or not isinstance(cache_ttl, (int, float)) or cache_ttl < 0:
+            raise ConfigError(f"Organization '{name}': tool_settings.{tool_name}.cache_ttl must be a non-negative number.")
+    tool_choice = org_config.get("tool_choice", "auto")
+    if isinstance(tool_choice, dict):
+        tool_choice = tool_choice.get("name")
+        if tool_choice not in tool_names:
+            raise ConfigError(f"Organization '{name}': tool_choice refers to unknown tool '{tool_choice}'.")
+    elif tool_choice not in TOOL_CHOICES:
+        raise ConfigError(f"Organization '{name}': tool_choice must be one of {', '.join(TOOL_CHOICES)}.")
+
+
+def parse_config(config_data):
+    # Validate every organization and pre-build its session template; returns {name: OrganizationConfig}
+    if not isinstance(config_data, dict):
+        raise ConfigError("config.json must contain an object keyed by organization.")
+    organizations = {}
+    for name, org_config in config_data.items():
+        validate_organization(name, org_config)
+        session_update = json.dumps({"type": "session.update", "session": build_session(org_config)})
+        organizations[name] = OrganizationConfig(name, freeze(org_config), session_update)
+    return MappingProxyType(organizations)
+
+
+def load_config(path='config.json'):
+    with open(path, 'r') as f:
+        return parse_config(json.load(f))
+
+
+class ConfigRegistry:
+    # Holds the parsed organizations and swaps them atomically when config.json changes.
+    # Sessions keep the OrganizationConfig they connected with; new sessions see the new one.
+    def __init__(self, path='config.json'):
+        self.path = path
+        self._mtime = os.stat(path).st_mtime_ns
+        self._organizations = load_config(path)
+        self.reloads = 0
+
+    def get(self, organization):
+        return self._organizations.get(organization)
+
+    def __len__(self):
+        return len(self._organizations)
+
+    def organizations(self):
+        return list(self._organizations.values())
+
+    def reload_if_changed(self):
+        # Returns True when a new configuration was loaded. An invalid file is logged and
+        # the previous configuration stays active.
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logging.error(f"Cannot stat {self.path}: {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            organizations = load_config(self.path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Ignoring invalid {self.path}, keeping the previous configuration: {e}")
+            return False
+        self._organizations = organizations
+        self.reloads += 1
+        logging.info(f"Reloaded {self.path} ({len(organizations)} organizations)")
+        return True
+
+    async def watch(self, interval=2.0):
+        while True:
+            await asyncio.sleep(interval)
+            # Parsing runs in a thread so a large file never blocks the event loop
+            await asyncio.to_thread(self.reload_if_changed)
@@ -0,0 +1,130 @@
+# event_log.py
+# Cheap logging for the relay hot path: level-gated, lazily formatted, with audio payloads
+# redacted, long strings truncated and high-frequency event types sampled. Every session
+# also keeps a bounded ring buffer of its recent events that is dumped when something fails.
+import os
+import json
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger("relay")
+
+# Fields that carry base64 audio; they are replaced by their size
+AUDIO_FIELDS = ("delta", "audio")
+MAX_STRING_LENGTH = int(os.getenv("LOG_MAX_STRING_LENGTH", "200"))
+
+# Log only one in N events of these types (LOG_SAMPLE_RATES="response.audio.delta=100,...")
+DEFAULT_SAMPLE_RATES = {
+    "response.audio.delta": 100,
+    "response.audio_transcript.delta": 20,
+    "response.text.delta": 20,
+    "client.audio": 10,
+}
+
+
+def parse_sample_rates(value):
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        event_type, _, rate = entry.partition("=")
+        rates[event_type.strip()] = max(int(rate), 1)
+    return rates
+
+
+SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+
+
+def redact(value, event_type=None, key=None):
+    # Copy of an event that is safe and small enough to log
+    if isinstance(value, dict):
+        return {k: redact(v, event_type, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, event_type) for v in value]
+    if isinstance(value, str):
+        if key in AUDIO_FIELDS and event_type and "audio" in event_type:
+            return f"<{len(value)} chars base64>"
+        if len(value) > MAX_STRING_LENGTH:
+            return f"{value[:MAX_STRING_LENGTH]}...<{len(value) - MAX_STRING_LENGTH} more chars>"
+    return value
+
+
+class Redacted:
+    # Defers redaction and serialization until a handler actually formats the record
+    __slots__ = ("event", "event_type")
+
+    def __init__(self, event, event_type=None):
+        self.event = event
+        self.event_type = event_type
+
+    def __str__(self):
+        return json.dumps(redact(self.event, self.event_type), default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, including the structured fields passed with extra=
+    STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.STANDARD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    # LOG_LEVEL sets the level (INFO by default), LOG_FORMAT=json switches to structured output
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "text") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[handler])
+
+
+class SessionLog:
+    def __init__(self, organization, request_id, history_size=None):
+        self.context = {"organization": organization, "request_id": request_id}
+        history_size = history_size or int(os.getenv("LOG_SESSION_HISTORY", "200"))
+        # (monotonic time, direction, event type, size in bytes, event); high-frequency events
+        # are kept without their payload so the buffer stays small
+        self.history = deque(maxlen=history_size)
+        self._counts = {}
+
+    def event(self, direction, event_type, event=None, size=0):
+        # Record an event in the ring buffer and log it at DEBUG, sampled per event type
+        sample_rate = SAMPLE_RATES.get(event_type, 1)
+        self.history.append((time.monotonic(), direction, event_type, size, None if sample_rate > 1 else event))
+        count = self._counts.get(event_type, 0) + 1
+        self._counts[event_type] = count
+        if logger.isEnabledFor(logging.DEBUG) and count % sample_rate == 1 % sample_rate:
+            logger.debug(
+                "%s %s (%d bytes, #%d): %s", direction, event_type, size, count, Redacted(event, event_type),
+                extra={**self.context, "direction": direction, "event_type": event_type, "size": size},
+            )
+
+    def info(self, message, *args):
+        logger.info(message, *args, extra=self.context)
+
+    def warning(self, message, *args):
+        logger.warning(message, *args, extra=self.context)
+
+    def dump(self, reason):
+        # Log the recent event timeline of this session, oldest first
+        if not self.history:
+            return
+        now = time.monotonic()
+        lines = [
+            f"  {now - ts:8.3f}s ago {direction:>8} {event_type} ({size} bytes)"
+            + (f" {Redacted(event, event_type)}" if event is not None else "")
+            for ts, direction, event_type, size, event in self.history
+        ]
+        logger.error(
+            "%s; last %d events of the session:\n%s", reason, len(lines), "\n".join(lines),
+            extra=self.context,
+        )
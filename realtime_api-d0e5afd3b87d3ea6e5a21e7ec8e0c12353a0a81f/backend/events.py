@@ -0,0 +1,67 @@
+# events.py
+# Parsing and dispatch of OpenAI Realtime events. Handlers register per event type, and the
+# high-frequency delta events skip the full json.loads: only their type and delta are extracted.
+import re
+import json
+
+# Event types parsed by scanning instead of json.loads; their handlers only get "type" and "delta"
+FAST_PATH_TYPES = frozenset({
+    "response.audio.delta",
+    "response.audio_transcript.delta",
+    "response.text.delta",
+})
+
+_TYPE_PREFIX = re.compile(r'\{\s*"type"\s*:\s*"([^"\\]+)"')
+_DELTA_KEY = re.compile(r'"delta"\s*:\s*"')
+
+
+def _scan_delta(message, start):
+    # Value of the "delta" string field, or None when it cannot be read without a full parse
+    key = _DELTA_KEY.search(message, start)
+    if key is None:
+        return None
+    end = message.find('"', key.end())
+    if end < 0:
+        return None
+    value = message[key.end():end]
+    # Base64 audio never contains escapes; text with escapes goes through json.loads
+    if "\\" in value:
+        return None
+    return value
+
+
+def parse_event(message):
+    # (event type, event) for one message from OpenAI. OpenAI sends "type" as the first field,
+    # which lets delta events be recognized from the prefix; anything else is parsed in full.
+    match = _TYPE_PREFIX.match(message)
+    if match is not None and match.group(1) in FAST_PATH_TYPES:
+        delta = _scan_delta(message, match.end())
+        if delta is not None:
+            return match.group(1), {"type": match.group(1), "delta": delta}
+    event = json.loads(message)
+    return event.get('type'), event
+
+
+class EventDispatcher:
+    # Maps event types to async handlers called as handler(session, event)
+    def __init__(self):
+        self._handlers = {}
+
+    def on(self, *event_types):
+        # Decorator registering a handler; a later registration for the same type replaces it
+        def register(handler):
+            for event_type in event_types:
+                self._handlers[event_type] = handler
+            return handler
+        return register
+
+    def handles(self, event_type):
+        return event_type in self._handlers
+
+    async def dispatch(self, session, event_type, event):
+        # Returns False when no handler is registered for the event type
+        handler = self._handlers.get(event_type)
+        if handler is None:
+            return False
+        await handler(session, event)
+        return True
@@ -0,0 +1,102 @@
+# ingest.py
+# Streaming input: small PCM frames are batched into input_audio_buffer.append messages as they
+# arrive, and turns are committed either by OpenAI's server VAD or by a local energy-based VAD
+import json
+import base64
+import numpy as np
+from audio import TARGET_SAMPLE_RATE
+
+BYTES_PER_MS = TARGET_SAMPLE_RATE * 2 // 1000  # 24kHz mono PCM16
+
+
+class EnergyVAD:
+    # Marks a turn as finished once speech has been followed by enough silence
+    def __init__(self, threshold_db=-45.0, silence_ms=500, min_speech_ms=200):
+        self.threshold_db = threshold_db
+        self.silence_ms = silence_ms
+        self.min_speech_ms = min_speech_ms
+        self.speech_ms = 0.0
+        self.trailing_silence_ms = 0.0
+
+    @staticmethod
+    def level_db(pcm_data):
+        samples = np.frombuffer(pcm_data, dtype='<i2').astype(np.float32)
+        if not len(samples):
+            return -120.0
+        rms = np.sqrt(np.mean(samples * samples))
+        return 20 * np.log10(max(rms, 1.0) / 32768.0)
+
+    def process(self, pcm_data):
+        # Returns True when this frame ends a turn
+        duration_ms = len(pcm_data) / BYTES_PER_MS
+        if self.level_db(pcm_data) >= self.threshold_db:
+            self.speech_ms += duration_ms
+            self.trailing_silence_ms = 0.0
+            return False
+        if self.speech_ms == 0:
+            return False
+        self.trailing_silence_ms += duration_ms
+        if self.trailing_silence_ms < self.silence_ms:
+            return False
+        ended = self.speech_ms >= self.min_speech_ms
+        # Too little speech to be a turn (a cough, a click) is discarded
+        self.speech_ms = 0.0
+        self.trailing_silence_ms = 0.0
+        return ended
+
+
+class StreamingIngest:
+    def __init__(self, openai_ws, server_vad, batch_ms=100, vad=None):
+        self.openai_ws = openai_ws
+        # With server VAD (turn_detection in config.json) OpenAI commits and responds by itself
+        self.server_vad = server_vad
+        self.batch_bytes = max(int(batch_ms * BYTES_PER_MS), 2)
+        self.vad = None if server_vad else (vad or EnergyVAD())
+        self._buffer = bytearray()
+        self._uncommitted = 0  # bytes appended since the last commit
+        self.sent = 0  # messages sent upstream
+
+    @classmethod
+    def for_organization(cls, openai_ws, org_settings):
+        vad_settings = org_settings.get("input_vad", {})
+        server_vad = org_settings.get("turn_detection") is not None
+        return cls(
+            openai_ws,
+            server_vad=server_vad,
+            batch_ms=org_settings.get("input_append_batch_ms", 100),
+            vad=None if server_vad else EnergyVAD(
+                threshold_db=vad_settings.get("threshold_db", -45.0),
+                silence_ms=vad_settings.get("silence_ms", 500),
+                min_speech_ms=vad_settings.get("min_speech_ms", 200),
+            ),
+        )
+
+    async def feed(self, pcm_data):
+        # Buffer one frame and send full batches; returns True when the frame completed a turn
+        self._buffer.extend(pcm_data)
+        if len(self._buffer) >= self.batch_bytes:
+            await self.flush()
+        if self.vad is not None and self.vad.process(pcm_data):
+            return await self.commit()
+        return False
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        audio = base64.b64encode(self._buffer).decode('utf-8')
+        self._uncommitted += len(self._buffer)
+        self._buffer.clear()
+        await self.openai_ws.send(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+        self.sent += 1
+
+    async def commit(self):
+        # Send what is buffered, then close the turn and ask for a response.
+        # Returns False when there is no audio to commit.
+        await self.flush()
+        if not self._uncommitted:
+            return False
+        self._uncommitted = 0
+        await self.openai_ws.send(json.dumps({"type": "input_audio_buffer.commit"}))
+        await self.openai_ws.send(json.dumps({"type": "response.create"}))
+        self.sent += 2
+        return True
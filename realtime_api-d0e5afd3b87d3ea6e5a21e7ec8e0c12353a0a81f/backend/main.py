@@ -5,21 +5,115 @@ import json
 import base64
 import asyncio
 import logging
-import io
-import wave
+import time
+import redis
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Response
 from fastapi.middleware.cors import CORSMiddleware
-from websockets.client import connect
-import redis  # Import Redis
-from pydub import AudioSegment  # For audio processing
-from websockets.client import connect
 from starlette.websockets import WebSocketState
+from audio import pcm_to_wav, frame_audio_chunk, fast_path_pcm, audio_input_from_query
+from transcoding import create_transcode_pool, TranscodeOverloaded
+from storage import create_conversation_store
+from config import ConfigRegistry
+from ingest import StreamingIngest
+from relay import create_senders, queued_to_clients, queued_to_upstream, run_relay
+from upstream import UpstreamPool
+from event_log import SessionLog, Redacted, configure_logging
+from events import EventDispatcher, parse_event
+from tool_registry import ToolRegistry
+from sessions import REPLAY_ITEM_PREFIX, SessionLease, replay_items
+from recorder import RecordedFrontend, RecordedUpstream, recorder_for
+from protocol import (
+    AUDIO, COMMAND_COMMIT, COMMAND_DOCUMENT, COMMAND_DOWNLOAD, COMMAND_DOWNLOAD_PAGE, COMMAND_IMAGE, COMMAND_TEXT,
+    JsonFraming, ProtocolError, decode_client_frame, framing_for, parse_text_command,
+)
+from metrics import (
+    SessionMetrics, WebSocketBytesMiddleware, metrics_response, observe_event, record_usage, track_queue_depth,
+)
 
 load_dotenv()
 
-app = FastAPI()
+# Set up by the lifespan handler below, not at import time
+config_registry = None
+store = None
+transcode_pool = None
+upstream_pool = None
+
+# Default caps on a stored conversation, for organizations that do not set history_max_messages
+# or history_max_bytes (0 disables a cap); the oldest messages are evicted first
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', '1000'))
+HISTORY_MAX_BYTES = int(os.getenv('HISTORY_MAX_BYTES', str(1024 * 1024)))
+# Messages per DOWNLOAD_CHAT_HISTORY_PAGE reply
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '100'))
+
+
+def history_limits(organization):
+    org_config = config_registry.get(organization) if config_registry else None
+    settings = org_config.settings if org_config else {}
+    return (
+        settings.get("history_max_messages", HISTORY_MAX_MESSAGES),
+        settings.get("history_max_bytes", HISTORY_MAX_BYTES),
+    )
+
+@asynccontextmanager
+async def lifespan(app):
+    global config_registry, store, transcode_pool, upstream_pool
+    started = time.perf_counter()
+
+    # Validate config.json once and pre-build an immutable session.update payload per organization.
+    # The file is watched afterwards so prompt and tool changes apply to new sessions without a restart
+    config_registry = ConfigRegistry(os.getenv('CONFIG_PATH', 'config.json'))
+    reload_interval = float(os.getenv('CONFIG_RELOAD_INTERVAL', '2'))
+    config_task = asyncio.create_task(config_registry.watch(reload_interval)) if reload_interval > 0 else None
+
+    # Async Redis connection pool and the background writer for conversation history.
+    # Redis is connected lazily: an unreachable Redis is reported, not fatal, and the health
+    # monitor keeps pinging so the pool reconnects as soon as it is back
+    store = create_conversation_store(history_limits)
+    health_task = asyncio.create_task(store.monitor_health(float(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '15'))))
+
+    # Worker pool that keeps pydub/ffmpeg transcoding off the event loop
+    transcode_pool = create_transcode_pool()
+
+    # Pre-connected OpenAI sessions for organizations that set upstream_pool_size
+    upstream_pool = UpstreamPool(
+        OPENAI_WS_URL,
+        OPENAI_WS_HEADERS,
+        max_idle_seconds=float(os.getenv('UPSTREAM_POOL_MAX_IDLE', '300')),
+        ping_interval=float(os.getenv('UPSTREAM_POOL_PING_INTERVAL', '20')),
+        connect_timeout=float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '10')),
+    )
+    pool_task = asyncio.create_task(upstream_pool.run(config_registry.organizations))
+
+    # Queue lengths are sampled when /metrics is scraped
+    track_queue_depth("transcode", lambda: transcode_pool.pending)
+    track_queue_depth("redis_writes", lambda: store.pending)
+    track_queue_depth("client_out", queued_to_clients)
+    track_queue_depth("upstream_out", queued_to_upstream)
+
+    app.state.startup_seconds = time.perf_counter() - started
+    logging.info(f"Startup completed in {app.state.startup_seconds * 1000:.1f} ms ({len(config_registry)} organizations)")
+    try:
+        yield
+    finally:
+        health_task.cancel()
+        pool_task.cancel()
+        await upstream_pool.close()
+        if config_task:
+            config_task.cancel()
+        transcode_pool.shutdown()
+        await store.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Bytes exchanged with the frontend, per organization
+app.add_middleware(
+    WebSocketBytesMiddleware,
+    path_prefix="/gpt-api/chat_stream/",
+    known_organization=lambda organization: config_registry is not None and config_registry.get(organization) is not None,
+)
 
 # CORS settings
 app.add_middleware(
@@ -38,41 +132,36 @@ if not OPENAI_API_KEY:
     raise ValueError("OpenAI API Key not found.")
 
 # WebSocket URL and headers for OpenAI Realtime API
-OPENAI_WS_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
+# (overridable so the relay can be pointed at a local mock Realtime server)
+OPENAI_WS_URL = os.getenv("OPENAI_WS_URL", "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01")
 OPENAI_WS_HEADERS = {
     "Authorization": f"Bearer {OPENAI_API_KEY}",
     "OpenAI-Beta": "realtime=v1",
 }
 
-# Initialize logging
-logging.basicConfig(level=logging.INFO)
+# Initialize logging (LOG_LEVEL, LOG_FORMAT=json, LOG_SAMPLE_RATES)
+configure_logging()
+
+@app.get("/health")
+async def health():
+    return {
+        "redis": "ok" if store.healthy else "unavailable",
+        "organizations": len(config_registry),
+        "config_reloads": config_registry.reloads,
+        "startup_seconds": app.state.startup_seconds,
+    }
 
-# Load configurations from JSON
-with open('config.json', 'r') as f:
-    config_data = json.load(f)
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_response()
+    return Response(content=body, media_type=content_type)
 
-# Initialize Redis client
-def get_redis():
-    redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-    redis_password = os.getenv('REDIS_PASSWORD', None)
-    if redis_password:
-        scheme, rest = redis_url.split("://", 1)
-        redis_url = f"{scheme}://:{redis_password}@{rest}"
-    try:
-        client = redis.from_url(redis_url)
-        if client.ping():
-            logging.info("Successfully connected to Redis.")
-            return client
-        else:
-            raise ConnectionError("Failed to ping Redis.")
-    except redis.RedisError as e:
-        logging.error(f"Redis connection error: {e}")
-        raise
-
-# Initialize the Redis client
-r = get_redis()
+# Function tools the model can call; an organization gets those listed in its config.json "tools".
+# Plain functions run in a thread, async ones on the loop, each with a timeout and optional caching.
+tool_registry = ToolRegistry(cache_size=int(os.getenv("TOOL_CACHE_SIZE", "1024")))
 
 # Define function for dummy implementation
+@tool_registry.register(timeout=10, cache_ttl=300)
 def get_current_weather(location, unit="fahrenheit"):
     # The Dummy implementation requested;but later, i will it replace with real API call when needed
     weather_data = {
@@ -90,7 +179,8 @@ async def chat_stream(websocket: WebSocket, organization: str, request_id: str):
     try:
         logging.info(f"Frontend WebSocket connected for organization: {organization}, request_id: {request_id}")
 
-        org_config = config_data.get(organization)
+        # Snapshot of the organization's config; a reload during the session does not affect it
+        org_config = config_registry.get(organization)
         if not org_config:
             error_message = f"Organization '{organization}' not found in configuration."
             logging.error(error_message)
@@ -98,22 +188,14 @@ async def chat_stream(websocket: WebSocket, organization: str, request_id: str):
             await websocket.close()
             return
 
-        # Build session configuration based on org_config
-        session_config = {
-            "type": "session.update",
-            "session": {
-                "voice": org_config.get("voice", "alloy"),
-                "instructions": org_config["prompts"]["instructions"],
-                "turn_detection": org_config.get("turn_detection"),
-                "input_audio_format": org_config.get("input_audio_format", "pcm16"),
-                "output_audio_format": org_config.get("output_audio_format", "pcm16"),
-                "input_audio_transcription": org_config.get("input_audio_transcription", {"model": "whisper-1"}),
-                "temperature": org_config.get("temperature", 0.8),
-                "tool_choice": org_config.get("tool_choice", "auto"),
-                "tools": org_config.get("tools", []),
-                "max_response_output_tokens": org_config.get("max_response_output_tokens", "inf")
-           }
-        }
+        # Clients that already produce PCM16 can negotiate it on connect, e.g.
+        # ?input_format=pcm16&sample_rate=24000&channels=1, so their audio skips pydub/ffmpeg
+        audio_input = audio_input_from_query(websocket.query_params)
+        # ?protocol=binary switches the client link to typed binary frames (protocol.py)
+        framing = framing_for(websocket.query_params, org_config.settings)
+        # Opt-in recording of every frame for offline replay (recorder.py, tools/replay.py)
+        recorder = recorder_for(org_config, request_id, websocket.query_params)
+        frontend_ws = RecordedFrontend(websocket, recorder) if recorder else websocket
 
     except Exception as e:
         logging.error(f"Error during WebSocket setup: {e}")
@@ -121,42 +203,170 @@ async def chat_stream(websocket: WebSocket, organization: str, request_id: str):
         await websocket.close()
         return
 
-    try:
-        async with connect(
-            OPENAI_WS_URL,
-            extra_headers=OPENAI_WS_HEADERS
-        ) as openai_ws:
-            logging.info("Connected to OpenAI Realtime API")
-
-            # Send session configuration
-            await openai_ws.send(json.dumps(session_config))
-
-            # Start tasks for bidirectional communication
-            chat_history = []
-            await asyncio.gather(
-                handle_frontend_to_openai(websocket, openai_ws, organization, request_id, chat_history),
-                handle_openai_to_frontend(websocket, openai_ws, organization, request_id, chat_history),
+    # Only one connection per request_id is live across all workers: this one takes the session
+    # over, and a previous owner (here or on another worker) ends its relay at its next renewal
+    lease = SessionLease(store.client, organization, request_id, ttl=float(os.getenv('SESSION_LEASE_TTL', '15')))
+    history = []
+    if store.healthy is False:
+        # Connect retries against a Redis known to be down would only delay the first response:
+        # start without history, keep_session_lease takes the lease once Redis is back
+        logging.warning(f"Redis unavailable, session {organization}:{request_id} starts without restored history")
+    else:
+        try:
+            history = await asyncio.wait_for(
+                restore_session(lease, organization, request_id), float(os.getenv('SESSION_RESTORE_TIMEOUT', '2')),
             )
+        except (redis.RedisError, asyncio.TimeoutError) as e:
+            logging.error(f"Could not restore session {organization}:{request_id} from Redis: {e!r}")
+
+    try:
+        # Pre-connected session from the pool, or a fresh connection with session.update sent
+        openai_ws = await upstream_pool.acquire(org_config)
+        relayed_ws = RecordedUpstream(openai_ws, recorder) if recorder else openai_ws
+        # Replay the stored messages before anything the client sends now
+        for item_event in replay_items(history):
+            await relayed_ws.send(item_event)
+        # Bounded queues towards the client and towards OpenAI, each drained by its own writer
+        client_out, upstream_out = create_senders(frontend_ws, relayed_ws, framing)
+        if history:
+            await client_out.send_control(json.dumps({"session_restored": {"messages": len(history)}}))
+        try:
+            with SessionMetrics(organization) as session_metrics:
+                # Start tasks for bidirectional communication
+                session_log = SessionLog(organization, request_id)
+                await run_relay(
+                    handle_frontend_to_openai(
+                        frontend_ws, upstream_out, client_out, organization, request_id, org_config,
+                        session_log, session_metrics, audio_input, framing,
+                    ),
+                    handle_openai_to_frontend(
+                        client_out, relayed_ws, upstream_out, organization, request_id, org_config,
+                        session_log, session_metrics,
+                    ),
+                    client_out,
+                    upstream_out,
+                    watchers=[keep_session_lease(lease, client_out)],
+                )
+                # The relay ended from the OpenAI side or the session moved: close the client cleanly
+                if websocket.client_state == WebSocketState.CONNECTED:
+                    await websocket.close()
+        finally:
+            # A session the client never used can go back to the pool
+            await upstream_pool.release(org_config, openai_ws, reusable=upstream_out.queued == 0 and not history)
 
     except WebSocketDisconnect:
         logging.info("Frontend WebSocket disconnected")
     except Exception as e:
         logging.error(f"Error: {e}")
         await websocket.send_text(json.dumps({"error": str(e)}))
-
-async def handle_frontend_to_openai(frontend_ws: WebSocket, openai_ws, organization, request_id, chat_history):
+    finally:
+        await lease.release()
+        if recorder:
+            recorder.close()
+
+
+async def restore_session(lease, organization, request_id):
+    previous_owner = await lease.acquire()
+    if previous_owner:
+        logging.info(f"Taking over session {organization}:{request_id} from {previous_owner}")
+    # Recent history, so a reconnect (to any worker) continues the same conversation
+    return await load_history(organization, request_id)
+
+
+async def load_history(organization, request_id):
+    # Messages replayed into a new upstream session for this request_id (SESSION_REPLAY_ITEMS, 0 disables)
+    count = int(os.getenv('SESSION_REPLAY_ITEMS', '20'))
+    if count <= 0:
+        return []
+    # Writes of a previous connection handled by this worker may still be queued; a new
+    # conversation has none and does not wait
+    if not await store.flush_conversation(organization, request_id, timeout=1):
+        logging.warning("Conversation writes still pending, restored history may miss the latest messages")
+    return await store.load_recent(organization, request_id, count)
+
+
+async def keep_session_lease(lease, client_out):
+    # Returns, ending the relay, once another connection took the session over
+    await lease.keep()
+    logging.info(f"Session {lease.key} was taken over by another connection")
+    await client_out.send_control(json.dumps({
+        "error": "This conversation was resumed from another connection.",
+        "code": "session_moved",
+    }))
+
+
+async def handle_frontend_to_openai(frontend_ws: WebSocket, openai_ws, client_out, organization, request_id, org_config, session_log, session_metrics, audio_input=None, framing=None):
+    # openai_ws and client_out are the bounded senders from relay.py; awaiting them applies backpressure
+    audio_input = audio_input or {}
+    framing = framing or JsonFraming()
+    # Streaming ingest batches small frames; turns are committed by server or local VAD
+    ingest = StreamingIngest.for_organization(openai_ws, org_config.settings) if audio_input.get("mode") == "stream" else None
     while True:
         try:
             message = await frontend_ws.receive()
+            started = time.perf_counter()
             message_type = message.get('type')
 
             if message_type == 'websocket.receive':
-                if 'bytes' in message and message['bytes'] is not None:
-                    audio_chunk = message['bytes']
-                    logging.info(f"Received audio chunk of size {len(audio_chunk)} bytes from frontend")
+                # Either an audio chunk or a (command, argument) pair, whichever protocol the client speaks
+                audio_chunk = command = argument = None
+                if message.get('bytes') is not None:
+                    if framing.binary:
+                        try:
+                            command, argument = decode_client_frame(message['bytes'])
+                        except ProtocolError as e:
+                            await client_out.send_control(json.dumps({"error": str(e), "code": "protocol_error"}))
+                            continue
+                        if command == AUDIO:
+                            audio_chunk, command = argument, None
+                        else:
+                            session_log.event("client", "client.text", size=len(message['bytes']))
+                    else:
+                        audio_chunk = message['bytes']
+                elif message.get('text') is not None:
+                    text_data = message['text']
+                    session_log.event("client", "client.text", text_data, size=len(text_data))
+                    command, argument = parse_text_command(text_data)
+                else:
+                    logging.warning("Received message with no 'text' or 'bytes' from frontend.")
+                    continue
+
+                if audio_chunk is not None:
+                    session_log.event("client", "client.audio", size=len(audio_chunk))
+
+                    # PCM16 and WAV input is passed straight through (or resampled with NumPy)
+                    pcm_audio = fast_path_pcm(
+                        audio_chunk,
+                        audio_input.get("format"),
+                        audio_input.get("sample_rate", 24000),
+                        audio_input.get("channels", 1),
+                    )
+                    base64_audio = None
+                    if pcm_audio is None:
+                        # Anything else is converted with pydub/ffmpeg in the transcoding pool
+                        try:
+                            base64_audio, timings = await transcode_pool.transcode(
+                                organization,
+                                audio_chunk,
+                                concurrency=org_config.settings.get("transcode_concurrency"),
+                            )
+                        except TranscodeOverloaded as e:
+                            logging.warning(f"Rejected audio chunk for {organization}:{request_id}: {e}")
+                            await client_out.send_control(json.dumps({"error": str(e), "code": "transcode_overloaded"}))
+                            continue
+                        session_log.event("internal", "transcode", timings, size=len(audio_chunk))
+
+                    if ingest is not None:
+                        # Streaming mode: append in batches, commit only when the turn ends
+                        if pcm_audio is None:
+                            pcm_audio = base64.b64decode(base64_audio)
+                        if await ingest.feed(pcm_audio):
+                            session_metrics.input_sent()
+                        observe_event("client", "client.audio", started)
+                        continue
 
-                    # Process audio to match OpenAI requirements
-                    base64_audio = process_audio(audio_chunk)
+                    if base64_audio is None:
+                        base64_audio = base64.b64encode(pcm_audio).decode('utf-8')
 
                     # Send audio data to OpenAI Realtime API
                     await openai_ws.send(json.dumps({
@@ -167,319 +377,353 @@ async def handle_frontend_to_openai(frontend_ws: WebSocket, openai_ws, organizat
                     # Optionally commit and request a response
                     await openai_ws.send(json.dumps({"type": "input_audio_buffer.commit"}))
                     await openai_ws.send(json.dumps({"type": "response.create"}))
+                    session_metrics.input_sent()
+                    observe_event("client", "client.audio", started)
 
-                elif 'text' in message and message['text'] is not None:
-                    text_data = message['text']
-                    logging.info(f"Received text message from frontend: {text_data}")
-
-                    # Parse the text_data as JSON to extract the actual text content
-
+                elif command == COMMAND_DOCUMENT:
+                    # Handle special signals as Vladimar sent me on slack
+                    logging.info("Document received")
+                    # TODO: In The future Add processing for the document
+                    # For now, send acknowledgment to frontend
+                    await client_out.send_control(json.dumps({"info": "Document received"}))
+
+                elif command == COMMAND_IMAGE:
+                    logging.info("Image received")
+                    # TODO: Add processing for the image
+                    # For now, send acknowledgment to frontend
+                    await client_out.send_control(json.dumps({"info": "Image received"}))
+
+                elif command == COMMAND_COMMIT:
+                    # Push-to-talk end of turn for streaming clients without server VAD
+                    if ingest is not None and not ingest.server_vad and await ingest.commit():
+                        session_metrics.input_sent()
+
+                elif command == COMMAND_DOWNLOAD:
+                    logging.info("User requested to download chat history.")
+                    # Retrieve chat history from Redis
+                    # Make sure this session's queued writes have landed before reading; if they are
+                    # still pending after the timeout, what is already stored is served
+                    await store.flush_conversation(organization, request_id, timeout=5)
                     try:
-                        parsed_message = json.loads(text_data)
-                        text_content = parsed_message.get('text', text_data)
-                    except json.JSONDecodeError:
-                        text_content = text_data
+                        conversation_data = await store.load(organization, request_id)
+                    except redis.RedisError as e:
+                        logging.error(f"Could not load chat history for {organization}:{request_id}: {e}")
+                        await client_out.send_control(json.dumps({"error": "Chat history is unavailable, please retry."}))
+                        continue
+                    if conversation_data:
+                        # Send the conversation data back to the frontend
+                        await client_out.send_control(json.dumps({
+                            "chat_history": conversation_data
+                        }))
+                    else:
+                        await client_out.send_control(json.dumps({"error": "Chat history not found."}))
 
-                    # Handle special signals as Vladimar sent me on slack
-                    if text_content.startswith("DOCUMENT_SENT:"):
-                        logging.info("Document received")
-                        # TODO: In The future Add processing for the document
-                        # For now, send acknowledgment to frontend
-                        await frontend_ws.send_text(json.dumps({"info": "Document received"}))
+                elif command == COMMAND_DOWNLOAD_PAGE:
+                    # Paged download: the argument is the cursor, 0 for the first page, then the
+                    # "next" value of the previous page's metadata until it is null
+                    if argument is None:
+                        await client_out.send_control(json.dumps({"error": "Invalid chat history cursor."}))
                         continue
-                    elif text_content.startswith("IMAGE_SENT:"):
-                        logging.info("Image received")
-                        # TODO: Add processing for the image
-                        # For now, send acknowledgment to frontend
-                        await frontend_ws.send_text(json.dumps({"info": "Image received"}))
+                    await store.flush_conversation(organization, request_id, timeout=5)
+                    try:
+                        page = await store.load_page(organization, request_id, argument, HISTORY_PAGE_SIZE)
+                    except redis.RedisError as e:
+                        logging.error(f"Could not load chat history for {organization}:{request_id}: {e}")
+                        await client_out.send_control(json.dumps({"error": "Chat history is unavailable, please retry."}))
                         continue
-
-                    elif text_content == "DOWNLOAD_CHAT_HISTORY_BUTTON_CLICKED":
-                        logging.info("User requested to download chat history.")
-                        # Retrieve chat history from Redis
-                        redis_key = f"{organization}:conversation:{request_id}"
-                        conversation_data = r.get(redis_key)
-                        if conversation_data:
-                            # Send the conversation data back to the frontend
-                            await frontend_ws.send_text(json.dumps({
-                                "chat_history": json.loads(conversation_data)
-                            }))
-                        else:
-                            await frontend_ws.send_text(json.dumps({"error": "Chat history not found."}))
-                        continue  # Then i guess i will  Continue to the next iteration of the loop
-
-
+                    if page:
+                        await client_out.send_control(json.dumps({"chat_history_page": page}))
                     else:
-                        # Save user message to chat history
-                        chat_history.append({
-                            'sender': 'user',
-                            'message': text_content,
-                            'timestamp':  datetime.now(timezone.utc).isoformat()
-                        })
-
-                        # Send text message to OpenAI
-                        await openai_ws.send(json.dumps({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "message",
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "input_text",
-                                        "text": text_content
-                                    }
-                                ]
-                            }
-                        }))
-
-                        # Request a response from OpenAI
-                        await openai_ws.send(json.dumps({"type": "response.create"}))
+                        await client_out.send_control(json.dumps({"error": "Chat history not found."}))
+
+                elif command == COMMAND_TEXT:
+                    text_content = argument
+                    # Queue the user message for the stored conversation (Redis)
+                    user_message = {
+                        'sender': 'user',
+                        'message': text_content,
+                        'timestamp':  datetime.now(timezone.utc).isoformat()
+                    }
+                    store.append(organization, request_id, user_message)
+
+                    # Send text message to OpenAI
+                    await openai_ws.send(json.dumps({
+                        "type": "conversation.item.create",
+                        "item": {
+                            "type": "message",
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "input_text",
+                                    "text": text_content
+                                }
+                            ]
+                        }
+                    }))
 
-                else:
-                    logging.warning("Received message with no 'text' or 'bytes' from frontend.")
+                    # Request a response from OpenAI
+                    await openai_ws.send(json.dumps({"type": "response.create"}))
+                    session_metrics.input_sent()
+                    observe_event("client", "client.text", started)
 
             elif message_type == 'websocket.disconnect':
                 logging.info("Frontend WebSocket disconnected")
                 break
 
         except Exception as e:
-            logging.error(f"Error in frontend to OpenAI communication: {e}")
+            session_log.dump(f"Error in frontend to OpenAI communication: {e}")
             break
 
-async def handle_openai_to_frontend(frontend_ws: WebSocket, openai_ws, organization, request_id, chat_history):
-    audio_chunks = bytearray()  # Accumulator for audio data
-    async for message in openai_ws:
-        try:
-            # Log the raw message and its type
-            logging.info(f"Received message from OpenAI of type {type(message)}")
+class OpenAIEventSession:
+    # State of one session shared by the OpenAI event handlers below
+    def __init__(self, frontend_ws, upstream_out, organization, request_id, org_config, session_log, session_metrics):
+        # frontend_ws and upstream_out are the bounded senders from relay.py
+        self.frontend_ws = frontend_ws
+        self.upstream_out = upstream_out
+        self.organization = organization
+        self.request_id = request_id
+        self.org_config = org_config
+        self.session_log = session_log
+        self.session_metrics = session_metrics
+        # "wav" buffers the whole reply into one WAV file, "stream" forwards each delta as it arrives
+        self.audio_output_mode = org_config.settings.get("audio_output_mode", "wav")
+        self.audio_stream_format = org_config.settings.get("audio_stream_format", "pcm16")
+        self.audio_chunks = bytearray()  # Accumulator for audio data (wav mode)
+        self.audio_seq = 0  # Sequence number of the next streamed audio frame (stream mode)
+        self.tools = tool_registry.for_organization(org_config)
+        self.tool_calls = set()  # call IDs already started, so a repeated event cannot run a call twice
+        self.tool_tasks = set()  # running tool calls, cancelled when the session ends
+
+    def start_tool_call(self, call_id, name, arguments):
+        # Tool calls run in the background so audio and text keep flowing while they wait on a backend
+        if call_id in self.tool_calls:
+            return
+        self.tool_calls.add(call_id)
+        task = asyncio.create_task(run_tool_call(self, call_id, name, arguments))
+        self.tool_tasks.add(task)
+        task.add_done_callback(self.tool_tasks.discard)
 
-            # Check if message is bytes and decode it
-            if isinstance(message, bytes):
-                message_text = message.decode('utf-8')
-            elif isinstance(message, str):
-                message_text = message
-            else:
-                # Handle unexpected message types
-                logging.error(f"Received unexpected message type from OpenAI: {type(message)}")
-                continue
 
-            # Parse the JSON message
-            event = json.loads(message_text)
-            logging.info(f"Received event from OpenAI: {event}")
+async def run_tool_call(session, call_id, name, arguments):
+    try:
+        function_args = json.loads(arguments or '{}')
+    except ValueError:
+        result = {"error": f"Invalid arguments for function '{name}'."}
+    else:
+        logging.info(f"Function call received: {name} with args {function_args}")
+        result = await session.tools.call(name, function_args)
 
-          
+    try:
+        output = json.dumps(result)
+    except (TypeError, ValueError) as e:
+        # The model must always get an output for the call, or it waits for one forever
+        logging.error(f"Result of function '{name}' is not JSON serializable: {e}")
+        output = json.dumps({"error": f"Function '{name}' returned a result that could not be serialized."})
+
+    # Send function_call_output to OpenAI
+    await session.upstream_out.send(json.dumps({
+        "type": "conversation.item.create",
+        "item": {
+            "type": "function_call_output",
+            "call_id": call_id,
+            "output": output
+        }
+    }))
 
-            # Ensure 'type' is in event
-            event_type = event.get('type')
-            if not event_type:
-                logging.error(f"No 'type' field in event: {event}")
-                continue
+    # Request the model to generate the assistant's response using the function call result
+    await session.upstream_out.send(json.dumps({"type": "response.create"}))
 
-            # Process the event based on its type
-            if event_type == 'conversation.item.created':
-                item = event.get('item', {})
-                item_type = item.get('type')
-                role = item.get('role')
-
-                if item_type == 'message' and role == 'assistant':
-                    # Extract the AI's message
-                    content_list = item.get('content', [])
-                    ai_message = ''
-                    for content in content_list:
-                        content_type = content.get('type')
-                        if content_type == 'text':
-                            ai_message += content.get('text', '')
-                        elif content_type == 'audio':
-                            ai_message += content.get('transcript', '')
-                    chat_history.append({
-                        'sender': 'bot',
-                        'message': ai_message,
-                        'timestamp': datetime.now(timezone.utc).isoformat()
-                    })
-                    # Save chat history to Redis
-                    save_conversation(organization, request_id, chat_history)
-                    # Optionally, send text_done to frontend
-                    if frontend_ws.client_state == WebSocketState.CONNECTED:
-                        await frontend_ws.send_text(json.dumps({"text_done": True}))
-
-                # if item_type == 'message' and role == 'assistant':
-                #     # Extract the AI's message
-                #     ai_message = ''.join([content.get('text', '') for content in item.get('content', [])])
-                #     chat_history.append({
-                #         'sender': 'bot',
-                #         'message': ai_message,
-                #         'timestamp':  datetime.now(timezone.utc).isoformat()
-                #     })
-                #     # Save chat history to Redis
-                #     save_conversation(organization, request_id, chat_history)
-                #     # Send text_done to frontend
-                #     await frontend_ws.send_text(json.dumps({"text_done": True}))
-
-                elif item_type == 'function_call':
-                    # Handle function call item
-                    function_call = item.get('function_call', {})
-                    function_name = function_call.get('name')
-                    function_args = json.loads(function_call.get('arguments', '{}'))
-                    call_id = item.get('id')
-
-                    logging.info(f"Function call received: {function_name} with args {function_args}")
-
-                    # Execute the function
-                    if function_name == 'get_current_weather':
-                        result = get_current_weather(**function_args)
-                    else:
-                        result = {"error": f"Function '{function_name}' not found."}
 
-                    # Send function_call_output to OpenAI
-                    await openai_ws.send(json.dumps({
-                        "type": "conversation.item.create",
-                        "item": {
-                            "type": "function_call_output",
-                            "call_id": call_id,
-                            "output": json.dumps(result)
-                        }
-                    }))
+# Handlers for events received from OpenAI, keyed on event type. Event types without a handler
+# are logged at DEBUG and ignored.
+openai_events = EventDispatcher()
 
-                    # Request the model to generate the assistant's response using the function call result
-                    await openai_ws.send(json.dumps({"type": "response.create"}))
 
-            elif event_type == 'response.text.delta':
-                text_delta = event.get('delta', '')
-                if frontend_ws.client_state == WebSocketState.CONNECTED:
-                    await frontend_ws.send_text(json.dumps({"text": text_delta}))
+@openai_events.on('conversation.item.created')
+async def on_item_created(session, event):
+    item = event.get('item', {})
+    item_type = item.get('type')
+    role = item.get('role')
 
-            elif event_type == 'response.text.done':
-                # Handle end of text response if needed
-                if frontend_ws.client_state == WebSocketState.CONNECTED:
-                    await frontend_ws.send_text(json.dumps({"text_done": True}))
+    # Echoes of the messages replayed into a restored session are not replies
+    if item_type == 'message' and role == 'assistant' and not item.get('id', '').startswith(REPLAY_ITEM_PREFIX):
+        # The item is still empty here; it is stored once complete in response.output_item.done
+        # Optionally, send text_done to frontend
+        await session.frontend_ws.send_control(json.dumps({"text_done": True}))
+    # Function calls are started from response.output_item.done, once their arguments are complete
 
-            elif event_type == 'response.audio.delta':
-                audio_base64 = event.get('delta', '')
-                if audio_base64:
-                    try:
-                        pcm_data = base64.b64decode(audio_base64)
-                        audio_chunks.extend(pcm_data)
-                    except Exception as e:
-                        logging.error(f"Error processing audio data: {e}")
-                else:
-                    logging.warning("Received 'response.audio.delta' event without 'delta' data.")
-
-            elif event_type == 'response.audio.done':
-                # Convert accumulated PCM data to WAV
-                if audio_chunks:
-                    wav_data = pcm_to_wav(bytes(audio_chunks))
-                    # Send WAV data as bytes to the frontend
-                    if frontend_ws.client_state == WebSocketState.CONNECTED:
-                        await frontend_ws.send_bytes(wav_data)
-                    # Clear the accumulator for future responses
-                    audio_chunks.clear()
-                if frontend_ws.client_state == WebSocketState.CONNECTED:
-                    await frontend_ws.send_text(json.dumps({"audio_done": True}))
-
-            elif event_type == 'error':
-                logging.error(f"Error from OpenAI: {event}")
-                error_message = event.get('error', {}).get('message', 'Unknown error')
-                if frontend_ws.client_state == WebSocketState.CONNECTED:
-                    await frontend_ws.send_text(json.dumps({"error": error_message}))
-
-
-            elif event_type == 'session.created':
-                logging.info("Session created event received from OpenAI.")
 
-                continue
+@openai_events.on('response.text.delta')
+async def on_text_delta(session, event):
+    session.session_metrics.output_received()
+    # Coalesced with other pending deltas if the client is slow
+    await session.frontend_ws.send_text_delta(event.get('delta', ''))
 
-            elif event_type == 'response.done':
-                logging.info("Response processing completed.")
-                # Optionally, you can handle usage statistics or perform cleanup
-                response = event.get('response', {})
-                # Log usage statistics if needed
-                usage = response.get('usage', {})
-                logging.info(f"Usage statistics: {usage}")
-                # You can also send a message to the frontend if necessary
-                continue  # Proceed to the next event
-            elif event_type == 'response.output_item.done':
-                item = event.get('item', {})
-                item_type = item.get('type')
-                role = item.get('role')
-
-                if item_type == 'message' and role == 'assistant':
-                    # Extract the AI's message
-                    content_list = item.get('content', [])
-                    ai_message = ''
-                    for content in content_list:
-                        content_type = content.get('type')
-                        if content_type == 'text':
-                            ai_message += content.get('text', '')
-                        elif content_type == 'audio':
-                            ai_message += content.get('transcript', '')
-                    chat_history.append({
-                        'sender': 'bot',
-                        'message': ai_message,
-                        'timestamp': datetime.now(timezone.utc).isoformat()
-                    })
-                    # Save chat history to Redis
-                    save_conversation(organization, request_id, chat_history)
-                logging.info("Output item processing completed.")
-
-            elif event_type == 'session.updated':
-                logging.info(f"Session updated: {event['session']}")
-                # Optionally, send session details to frontend
-                continue
-            else:
-                logging.info(f"Unhandled event type: {event_type}")
-                # Handle other event types as needed
 
-        except Exception as e:
-            logging.error(f"Error in OpenAI to frontend communication: {e}")
-            break
+@openai_events.on('response.text.done')
+async def on_text_done(session, event):
+    # Handle end of text response if needed
+    await session.frontend_ws.send_control(json.dumps({"text_done": True}))
 
-def save_conversation(organization, request_id, chat_history, expire_seconds=86400):
-    if not chat_history:
-        logging.warning("save_conversation called with empty chat_history.")
+
+@openai_events.on('response.audio.delta')
+async def on_audio_delta(session, event):
+    session.session_metrics.output_received()
+    audio_base64 = event.get('delta', '')
+    if not audio_base64:
+        logging.warning("Received 'response.audio.delta' event without 'delta' data.")
+        return
+    try:
+        pcm_data = base64.b64decode(audio_base64)
+    except Exception as e:
+        logging.error(f"Error processing audio data: {e}")
+        return
+    if session.audio_output_mode != 'stream':
+        session.audio_chunks.extend(pcm_data)
         return
+    if session.audio_seq == 0:
+        # Tell the client how to decode the frames that follow
+        await session.frontend_ws.send_audio_marker(json.dumps({"audio_start": {
+            "format": session.audio_stream_format,
+            "sample_rate": 24000,
+            "channels": 1,
+            "sample_width": 2,
+        }}))
+    await session.frontend_ws.send_audio(frame_audio_chunk(session.audio_seq, pcm_data, session.audio_stream_format))
+    session.audio_seq += 1
+
+
+@openai_events.on('response.audio.done')
+async def on_audio_done(session, event):
+    if session.audio_output_mode == 'stream':
+        # Closing marker carries the number of frames sent so the client can detect gaps
+        await session.frontend_ws.send_audio_marker(json.dumps({"audio_done": True, "audio_chunks": session.audio_seq}))
+        session.audio_seq = 0
+        return
+    # Convert accumulated PCM data to WAV
+    if session.audio_chunks:
+        wav_data = pcm_to_wav(bytes(session.audio_chunks))
+        # Send WAV data as bytes to the frontend
+        await session.frontend_ws.send_audio(wav_data)
+        # Clear the accumulator for future responses
+        session.audio_chunks.clear()
+    await session.frontend_ws.send_audio_marker(json.dumps({"audio_done": True}))
+
+
+@openai_events.on('error')
+async def on_error(session, event):
+    session.session_log.dump(f"Error from OpenAI: {Redacted(event)}")
+    error_message = event.get('error', {}).get('message', 'Unknown error')
+    # Control lane: delivered ahead of any queued audio
+    await session.frontend_ws.send_control(json.dumps({"error": error_message}))
+
+
+@openai_events.on('input_audio_buffer.speech_stopped')
+async def on_speech_stopped(session, event):
+    # Server VAD detected the end of the user's turn
+    session.session_metrics.input_sent()
+
+
+@openai_events.on('session.created')
+async def on_session_created(session, event):
+    logging.info("Session created event received from OpenAI.")
 
-    logging.info(f"Saving chat_history for {organization}:{request_id}")
-    metadata = {
-        'created': chat_history[0]['timestamp'],
-        'downloaded':  datetime.now(timezone.utc).isoformat(),
-        'number_of_requests': sum(1 for msg in chat_history if msg.get('sender') == 'user'),
-        'number_of_responses': sum(1 for msg in chat_history if msg.get('sender') == 'bot'),
+
+@openai_events.on('session.updated')
+async def on_session_updated(session, event):
+    logging.info("Session updated")
+
+
+@openai_events.on('response.done')
+async def on_response_done(session, event):
+    logging.debug("Response processing completed.")
+    # Log usage statistics
+    usage = event.get('response', {}).get('usage', {})
+    session.session_log.info("Usage statistics: %s", usage)
+    record_usage(session.organization, usage)
+
+
+@openai_events.on('conversation.item.input_audio_transcription.completed')
+async def on_input_transcription(session, event):
+    # What the user said, so voice turns are part of the stored (and replayable) conversation
+    transcript = event.get('transcript', '').strip()
+    if not transcript:
+        return
+    user_message = {
+        'sender': 'user',
+        'message': transcript,
+        'timestamp': datetime.now(timezone.utc).isoformat()
     }
-    redis_key = f"{organization}:conversation:{request_id}"
-    conversation_data = {'metadata': metadata, 'messages': chat_history}
+    store.append(session.organization, session.request_id, user_message, item_id=event.get('item_id'))
+
+
+@openai_events.on('response.output_item.done')
+async def on_output_item_done(session, event):
+    item = event.get('item', {})
+    if item.get('type') == 'function_call':
+        # Complete function call: name, call_id and the fully streamed arguments
+        session.start_tool_call(item.get('call_id'), item.get('name'), item.get('arguments'))
+    elif item.get('type') == 'message' and item.get('role') == 'assistant':
+        # Extract the AI's message
+        ai_message = ''
+        for content in item.get('content', []):
+            content_type = content.get('type')
+            if content_type == 'text':
+                ai_message += content.get('text', '')
+            elif content_type == 'audio':
+                ai_message += content.get('transcript', '')
+        bot_message = {
+            'sender': 'bot',
+            'message': ai_message,
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }
+        # Queue the append to Redis; the item ID keeps a message from being stored twice
+        store.append(session.organization, session.request_id, bot_message, item_id=item.get('id'))
+    logging.debug("Output item processing completed.")
+
+
+async def handle_openai_to_frontend(frontend_ws, openai_ws, upstream_out, organization, request_id, org_config, session_log, session_metrics):
+    # frontend_ws and upstream_out are the bounded senders from relay.py; openai_ws is only read here
+    session = OpenAIEventSession(
+        frontend_ws, upstream_out, organization, request_id, org_config, session_log, session_metrics,
+    )
     try:
-        r.setex(redis_key, expire_seconds, json.dumps(conversation_data))
-        logging.info(f"Conversation saved to Redis with key: {redis_key}")
-    except redis.RedisError as e:
-        logging.error(f"Failed to save conversation to Redis: {e}")
-
-def process_audio(raw_audio):
-    # Convert audio to 16-bit PCM, 24kHz, mono, little-endian
-    audio = AudioSegment.from_file(io.BytesIO(raw_audio))
-    audio = audio.set_frame_rate(24000).set_channels(1).set_sample_width(2)
-    pcm_audio = audio.raw_data
-
-    # Encode to base64
-    base64_audio = base64.b64encode(pcm_audio).decode('utf-8')
-    return base64_audio
-
-def pcm_to_wav(pcm_data):
-    # Define WAV file parameters
-    num_channels = 1
-    sample_width = 2  # 16-bit audio
-    frame_rate = 24000  # 24kHz
-
-    # Create a BytesIO object to hold WAV data
-    wav_io = io.BytesIO()
-
-    # Initialize WAV writer
-    with wave.open(wav_io, 'wb') as wav_file:
-        wav_file.setnchannels(num_channels)
-        wav_file.setsampwidth(sample_width)
-        wav_file.setframerate(frame_rate)
-        wav_file.writeframes(pcm_data)
-
-    # Get WAV data from BytesIO object
-    wav_data = wav_io.getvalue()
-    return wav_data
+        await relay_openai_events(session, openai_ws, session_log)
+    finally:
+        for task in session.tool_tasks:
+            task.cancel()
+
+
+async def relay_openai_events(session, openai_ws, session_log):
+    async for message in openai_ws:
+        started = time.perf_counter()
+        event_type = None
+        try:
+            # Check if message is bytes and decode it
+            if isinstance(message, bytes):
+                message_text = message.decode('utf-8')
+            elif isinstance(message, str):
+                message_text = message
+            else:
+                # Handle unexpected message types
+                logging.error(f"Received unexpected message type from OpenAI: {type(message)}")
+                continue
+
+            # Delta events are only scanned for their type and delta; everything else is parsed in full
+            event_type, event = parse_event(message_text)
+            if not event_type:
+                logging.error(f"No 'type' field in event: {str(Redacted(event))}")
+                continue
+            # Recorded in the session's ring buffer; logged (sampled, redacted) only at DEBUG
+            session_log.event("openai", event_type, event, size=len(message_text))
 
+            if not await openai_events.dispatch(session, event_type, event):
+                logging.debug("Unhandled event type: %s", event_type)
+
+        except Exception as e:
+            session_log.dump(f"Error in OpenAI to frontend communication: {e}")
+            break
+        finally:
+            # Time spent handling this event, by type
+            if event_type:
+                observe_event("openai", event_type, started)
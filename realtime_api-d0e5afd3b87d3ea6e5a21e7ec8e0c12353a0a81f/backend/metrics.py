@@ -0,0 +1,130 @@
+# metrics.py
+# Prometheus metrics for the relay, served by GET /metrics
+import time
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HANDLER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+ACTIVE_SESSIONS = Gauge(
+    "relay_active_sessions", "Frontend sessions currently relayed", ["organization"]
+)
+FIRST_RESPONSE_SECONDS = Histogram(
+    "relay_first_response_seconds",
+    "Time from the user's last audio frame or text message to the first assistant audio/text delta",
+    ["organization"], buckets=LATENCY_BUCKETS,
+)
+EVENT_HANDLING_SECONDS = Histogram(
+    "relay_event_handling_seconds", "Time spent handling one event, by direction and type",
+    ["direction", "event_type"], buckets=HANDLER_BUCKETS,
+)
+TRANSCODE_QUEUE_WAIT_SECONDS = Histogram(
+    "relay_transcode_queue_wait_seconds", "Time uploads wait for a transcoding worker", buckets=LATENCY_BUCKETS,
+)
+TRANSCODE_SECONDS = Histogram(
+    "relay_transcode_seconds", "Time spent transcoding one upload with pydub/ffmpeg", buckets=LATENCY_BUCKETS,
+)
+TRANSCODE_REJECTED = Counter(
+    "relay_transcode_rejected_total", "Uploads rejected because the transcoding queue was full"
+)
+REDIS_SECONDS = Histogram(
+    "relay_redis_seconds", "Latency of Redis operations", ["operation"], buckets=LATENCY_BUCKETS,
+)
+TOOL_SECONDS = Histogram(
+    "relay_tool_seconds", "Duration of function tool calls, by tool and outcome (ok, cached, error, timeout)",
+    ["tool", "outcome"], buckets=LATENCY_BUCKETS,
+)
+BYTES = Counter(
+    "relay_bytes_total", "Bytes exchanged with the frontend", ["organization", "direction"]
+)
+TOKENS = Counter(
+    "relay_tokens_total", "Token usage reported by OpenAI in response.done", ["organization", "type"]
+)
+QUEUE_DEPTH = Gauge(
+    "relay_queue_depth", "Items waiting in internal queues", ["queue"]
+)
+
+
+def metrics_response():
+    # (body, content type) for the /metrics endpoint
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def track_queue_depth(queue_name, get_depth):
+    # Sample a queue length at scrape time instead of updating it on every change
+    QUEUE_DEPTH.labels(queue_name).set_function(get_depth)
+
+
+def record_usage(organization, usage):
+    for token_type in ("input_tokens", "output_tokens", "total_tokens"):
+        if usage.get(token_type):
+            TOKENS.labels(organization, token_type.replace("_tokens", "")).inc(usage[token_type])
+
+
+class SessionMetrics:
+    # Per-session view of the metrics above, shared by both relay directions
+    def __init__(self, organization):
+        self.organization = organization
+        self.waiting_since = None  # when the user's last input was sent upstream
+        self._first_response = FIRST_RESPONSE_SECONDS.labels(organization)
+
+    def __enter__(self):
+        ACTIVE_SESSIONS.labels(self.organization).inc()
+        return self
+
+    def __exit__(self, *exc_info):
+        ACTIVE_SESSIONS.labels(self.organization).dec()
+
+    def input_sent(self):
+        self.waiting_since = time.perf_counter()
+
+    def output_received(self):
+        # Only the first delta after an input counts towards time to first response
+        if self.waiting_since is not None:
+            self._first_response.observe(time.perf_counter() - self.waiting_since)
+            self.waiting_since = None
+
+
+def observe_event(direction, event_type, started):
+    EVENT_HANDLING_SECONDS.labels(direction, event_type).observe(time.perf_counter() - started)
+
+
+def _frame_size(message):
+    if message.get("bytes") is not None:
+        return len(message["bytes"])
+    if message.get("text") is not None:
+        return len(message["text"].encode("utf-8"))
+    return 0
+
+
+class WebSocketBytesMiddleware:
+    # ASGI middleware counting the bytes of every frame exchanged on the relay endpoint.
+    # Organizations not in the configuration are counted as "unknown" to bound label cardinality.
+    def __init__(self, app, path_prefix, known_organization):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.known_organization = known_organization
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "websocket" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        organization = scope["path"][len(self.path_prefix):].split("/", 1)[0]
+        if not self.known_organization(organization):
+            organization = "unknown"
+        bytes_in = BYTES.labels(organization, "in")
+        bytes_out = BYTES.labels(organization, "out")
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "websocket.receive":
+                bytes_in.inc(_frame_size(message))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "websocket.send":
+                bytes_out.inc(_frame_size(message))
+            await send(message)
+
+        await self.app(scope, counting_receive, counting_send)
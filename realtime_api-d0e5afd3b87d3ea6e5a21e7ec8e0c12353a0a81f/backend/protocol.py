@@ -0,0 +1,165 @@
+# protocol.py
+# Framing of the link to the browser. The default is the original JSON protocol: text deltas as
+# {"text": ...}, control messages as JSON text frames, audio as untyped binary frames and client
+# signals as string prefixes (DOCUMENT_SENT:, DOWNLOAD_CHAT_HISTORY_BUTTON_CLICKED, ...).
+#
+# Clients that connect with ?protocol=binary get typed binary frames instead, in both directions:
+#   1 byte: frame type, with FLAG_ZLIB set when the payload is zlib-compressed
+#   rest:   payload
+# Server to client:
+#   AUDIO       audio exactly as in the JSON protocol (a streamed chunk with its sequence header, or a WAV file)
+#   TEXT_DELTA  UTF-8 text
+#   CONTROL     UTF-8 JSON of any other message (error, info, audio_start, audio_done, chat_history, ...)
+#   TEXT_DONE   empty
+# Client to server:
+#   AUDIO       an audio recording or streamed chunk
+#   TEXT        a UTF-8 user message
+#   CONTROL     1 byte signal code (SIGNAL_*) followed by its argument
+import os
+import json
+import zlib
+import struct
+
+AUDIO = 0x01
+TEXT_DELTA = 0x02
+TEXT = 0x02
+CONTROL = 0x03
+TEXT_DONE = 0x04
+FLAG_ZLIB = 0x80
+
+SIGNAL_DOCUMENT_SENT = 0x01
+SIGNAL_IMAGE_SENT = 0x02
+SIGNAL_INPUT_AUDIO_COMMIT = 0x03
+SIGNAL_DOWNLOAD_CHAT_HISTORY = 0x04
+SIGNAL_DOWNLOAD_CHAT_HISTORY_PAGE = 0x05  # argument: cursor as 4-byte big-endian unsigned integer
+
+CURSOR = struct.Struct('>I')
+
+# Largest payload a compressed client frame may expand to, the same as uvicorn's default
+# --ws-max-size, so compression never lets a frame grow past what could be sent uncompressed
+MAX_DECOMPRESSED_BYTES = int(os.getenv("CLIENT_MAX_DECOMPRESSED_BYTES", str(16 * 1024 * 1024)))
+
+# Client commands, whichever protocol they arrived in
+COMMAND_TEXT = "text"
+COMMAND_DOCUMENT = "document"
+COMMAND_IMAGE = "image"
+COMMAND_COMMIT = "commit"
+COMMAND_DOWNLOAD = "download"
+COMMAND_DOWNLOAD_PAGE = "download_page"
+
+TEXT_DONE_MESSAGE = json.dumps({"text_done": True})
+
+
+class ProtocolError(ValueError):
+    """Raised for a client frame that cannot be decoded."""
+
+
+def parse_text_command(text_data):
+    # (command, argument) for a text frame of the JSON protocol
+    try:
+        parsed_message = json.loads(text_data)
+        text_content = parsed_message.get('text', text_data) if isinstance(parsed_message, dict) else text_data
+    except json.JSONDecodeError:
+        text_content = text_data
+
+    if text_content.startswith("DOCUMENT_SENT:"):
+        return COMMAND_DOCUMENT, text_content[len("DOCUMENT_SENT:"):]
+    if text_content.startswith("IMAGE_SENT:"):
+        return COMMAND_IMAGE, text_content[len("IMAGE_SENT:"):]
+    if text_content == "INPUT_AUDIO_COMMIT":
+        return COMMAND_COMMIT, None
+    if text_content == "DOWNLOAD_CHAT_HISTORY_BUTTON_CLICKED":
+        return COMMAND_DOWNLOAD, None
+    if text_content.startswith("DOWNLOAD_CHAT_HISTORY_PAGE:"):
+        cursor = text_content.split(":", 1)[1].strip()
+        return COMMAND_DOWNLOAD_PAGE, int(cursor) if cursor.isdigit() else None
+    return COMMAND_TEXT, text_content
+
+
+_SIGNALS = {
+    SIGNAL_DOCUMENT_SENT: COMMAND_DOCUMENT,
+    SIGNAL_IMAGE_SENT: COMMAND_IMAGE,
+    SIGNAL_INPUT_AUDIO_COMMIT: COMMAND_COMMIT,
+    SIGNAL_DOWNLOAD_CHAT_HISTORY: COMMAND_DOWNLOAD,
+    SIGNAL_DOWNLOAD_CHAT_HISTORY_PAGE: COMMAND_DOWNLOAD_PAGE,
+}
+
+
+def decode_client_frame(data):
+    # (AUDIO, audio bytes) or (command, argument) for a binary frame of the binary protocol
+    if not data:
+        raise ProtocolError("Empty frame")
+    frame_type, payload = data[0], data[1:]
+    try:
+        if frame_type & FLAG_ZLIB:
+            frame_type &= ~FLAG_ZLIB
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, MAX_DECOMPRESSED_BYTES)
+            if decompressor.unconsumed_tail:
+                raise ProtocolError(f"Frame expands to more than {MAX_DECOMPRESSED_BYTES} bytes")
+            if not decompressor.eof:
+                raise ProtocolError("Malformed frame: incomplete compressed payload")
+        if frame_type == AUDIO:
+            return AUDIO, payload
+        if frame_type == TEXT:
+            return COMMAND_TEXT, payload.decode('utf-8')
+        if frame_type == CONTROL and payload:
+            command = _SIGNALS.get(payload[0])
+            argument = payload[1:]
+            if command == COMMAND_DOWNLOAD_PAGE:
+                if len(argument) != CURSOR.size:
+                    raise ProtocolError("Chat history cursor must be 4 bytes")
+                return command, CURSOR.unpack(argument)[0]
+            if command is not None:
+                return command, argument.decode('utf-8')
+    except (zlib.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed frame: {e}") from e
+    raise ProtocolError(f"Unknown frame type 0x{frame_type:02x}")
+
+
+class JsonFraming:
+    # The original protocol; frames are passed through as they are built
+    binary = False
+
+    def text_delta(self, text):
+        return json.dumps({"text": text})
+
+    def control(self, message):
+        return message
+
+    def audio(self, data):
+        return data
+
+
+class BinaryFraming:
+    binary = True
+
+    def __init__(self, compress_min_bytes=0):
+        # Text and control payloads of at least this size are zlib-compressed (0 disables);
+        # audio is never compressed
+        self.compress_min_bytes = compress_min_bytes
+
+    def _frame(self, frame_type, payload):
+        if self.compress_min_bytes and len(payload) >= self.compress_min_bytes:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                return bytes((frame_type | FLAG_ZLIB,)) + compressed
+        return bytes((frame_type,)) + payload
+
+    def text_delta(self, text):
+        return self._frame(TEXT_DELTA, text.encode('utf-8'))
+
+    def control(self, message):
+        if message == TEXT_DONE_MESSAGE:
+            return bytes((TEXT_DONE,))
+        return self._frame(CONTROL, message.encode('utf-8'))
+
+    def audio(self, data):
+        return bytes((AUDIO,)) + data
+
+
+def framing_for(query_params, org_settings):
+    # Negotiated on connect with ?protocol=binary; anything else keeps the JSON protocol
+    if query_params.get("protocol") == "binary":
+        return BinaryFraming(org_settings.get("client_compress_min_bytes", 0))
+    return JsonFraming()
@@ -0,0 +1,167 @@
+# recorder.py
+# Opt-in recording of relayed sessions, so a slow production session can be replayed and profiled
+# offline (tools/replay.py). Enabled by RECORDING_DIR together with "record_sessions": true in the
+# organization's config. A recording is an append-only file of records, each a header line
+# followed by the raw payload and a newline:
+#   <seconds since the session started> <stream> <payload length>\n<payload>\n
+# Streams:
+#   session         JSON: organization, request_id, start time, query parameters and org settings (first record)
+#   client.text     text frame received from the browser
+#   client.bytes    binary frame received from the browser
+#   openai          message received from OpenAI
+#   openai.audio    response.audio.delta received from OpenAI, stored as the decoded audio
+#   upstream        message sent to OpenAI
+#   upstream.audio  input_audio_buffer.append sent to OpenAI, stored as the decoded audio
+#   out.text        text frame sent to the browser
+#   out.bytes       binary frame sent to the browser
+#   truncated       the recording reached RECORDING_MAX_BYTES and stops here
+# Audio never goes through base64 in the file, which keeps recordings about 25% smaller.
+import os
+import re
+import json
+import time
+import base64
+import logging
+from datetime import datetime, timezone
+from events import parse_event
+
+RECORDING_DIR = os.getenv("RECORDING_DIR", "")
+# A session stops recording (and says so in its last record) once its file reaches this size
+RECORDING_MAX_BYTES = int(os.getenv("RECORDING_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class SessionRecorder:
+    def __init__(self, path, max_bytes=RECORDING_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Records are small and frequent: buffer them, the file is flushed on close
+        self._file = open(path, "ab", buffering=64 * 1024)
+        self._started = time.monotonic()
+
+    def record(self, stream, payload):
+        if self._file is None:
+            return
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self.size + len(payload) + 64 > self.max_bytes:
+            logging.warning(f"Recording {self.path} reached {self.max_bytes} bytes, no longer recording")
+            stream, payload = "truncated", b""
+        header = f"{time.monotonic() - self._started:.6f} {stream} {len(payload)}\n".encode("ascii")
+        self._file.write(header)
+        self._file.write(payload)
+        self._file.write(b"\n")
+        self.size += len(header) + len(payload) + 1
+        if stream == "truncated":
+            self.close()
+
+    def record_openai(self, message):
+        # Audio deltas are stored as the audio itself
+        event_type, event = parse_event(message)
+        if event_type == "response.audio.delta":
+            self.record("openai.audio", base64.b64decode(event.get("delta", "")))
+        else:
+            self.record("openai", message)
+
+    def record_upstream(self, message):
+        if '"input_audio_buffer.append"' in message[:64]:
+            self.record("upstream.audio", base64.b64decode(json.loads(message).get("audio", "")))
+        else:
+            self.record("upstream", message)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def recorder_for(org_config, request_id, query_params):
+    # A recorder for this session if recording is enabled for the organization, else None
+    if not RECORDING_DIR or not org_config.settings.get("record_sessions", False):
+        return None
+    started = datetime.now(timezone.utc)
+    directory = os.path.join(RECORDING_DIR, org_config.name)
+    name = f"{started:%Y%m%dT%H%M%S.%f}-{_UNSAFE_NAME.sub('_', request_id)[:64]}.rec"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        recorder = SessionRecorder(os.path.join(directory, name))
+    except OSError as e:
+        logging.error(f"Could not start recording for {org_config.name}:{request_id}: {e}")
+        return None
+    recorder.record("session", json.dumps({
+        "organization": org_config.name,
+        "request_id": request_id,
+        "started": started.isoformat(),
+        "query": dict(query_params),
+        "settings": org_config.settings,
+    }, default=dict))
+    logging.info(f"Recording session {org_config.name}:{request_id} to {recorder.path}")
+    return recorder
+
+
+class RecordedFrontend:
+    # The browser websocket as seen by the relay, with every frame in and out recorded
+    def __init__(self, websocket, recorder):
+        self.websocket = websocket
+        self.recorder = recorder
+
+    @property
+    def client_state(self):
+        return self.websocket.client_state
+
+    async def receive(self):
+        message = await self.websocket.receive()
+        if message.get("bytes") is not None:
+            self.recorder.record("client.bytes", message["bytes"])
+        elif message.get("text") is not None:
+            self.recorder.record("client.text", message["text"])
+        return message
+
+    async def send_text(self, data):
+        self.recorder.record("out.text", data)
+        await self.websocket.send_text(data)
+
+    async def send_bytes(self, data):
+        self.recorder.record("out.bytes", data)
+        await self.websocket.send_bytes(data)
+
+
+class RecordedUpstream:
+    # The OpenAI connection as seen by the relay, with every message in and out recorded
+    def __init__(self, openai_ws, recorder):
+        self.openai_ws = openai_ws
+        self.recorder = recorder
+
+    async def send(self, message):
+        self.recorder.record_upstream(message)
+        await self.openai_ws.send(message)
+
+    async def __aiter__(self):
+        async for message in self.openai_ws:
+            if isinstance(message, bytes):
+                self.recorder.record("openai", message)
+            else:
+                self.recorder.record_openai(message)
+            yield message
+
+
+def read_recording(path):
+    # (seconds, stream, payload bytes) for every record; a record cut short by a crash ends the file
+    with open(path, "rb") as f:
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            try:
+                seconds, stream, length = header.split()
+                seconds, length = float(seconds), int(length)
+            except ValueError:
+                logging.warning(f"Malformed record header in {path}: {header[:80]!r}")
+                return
+            payload = f.read(length)
+            if len(payload) < length or f.read(1) != b"\n":
+                logging.warning(f"Recording {path} ends with an incomplete record")
+                return
+            yield seconds, stream.decode("ascii"), payload
@@ -0,0 +1,190 @@
+# relay.py
+# Bounded queues between the two relay directions. Each socket gets a single writer task, so a
+# slow browser or a slow upstream only fills its own bounded queue and then pushes back on the
+# producer, instead of stalling the other direction or growing memory without limit.
+import os
+import asyncio
+import logging
+from collections import deque
+from starlette.websockets import WebSocketState
+from protocol import JsonFraming
+
+# Senders of the sessions currently relayed, for the queue depth metrics
+_active_senders = set()
+
+
+class ClientSender:
+    # Frames for the browser travel in two lanes, each kept in order:
+    #   control lane: text deltas and control messages (error, text_done, info, ...). Drained
+    #                 first, so an error is never stuck behind seconds of queued audio.
+    #   audio lane:   binary audio and the markers that frame it (audio_start, audio_done).
+    # Text deltas that pile up while the client is slow are coalesced into one frame, up to
+    # max_text_chars of pending text. Past that, new deltas wait for the writer ("coalesce") or
+    # are discarded ("drop"). Frames are queued as built and encoded for the client's protocol
+    # (protocol.py) by the writer.
+    def __init__(self, websocket, max_audio_bytes=2 * 1024 * 1024, max_control=256, text_delta_policy="coalesce", framing=None,
+                 max_text_chars=64 * 1024):
+        self.websocket = websocket
+        self.framing = framing or JsonFraming()
+        self.max_audio_bytes = max_audio_bytes
+        self.max_control = max_control
+        self.max_text_chars = max_text_chars
+        self.text_delta_policy = text_delta_policy
+        self._control = deque()  # str, or list of pending text deltas
+        self._audio = deque()    # bytes or str
+        self._audio_bytes = 0
+        self._text_chars = 0     # pending text deltas, over all lists in the control lane
+        self._closed = False
+        self._changed = asyncio.Condition()
+        self.stats = {"coalesced": 0, "dropped": 0}
+
+    async def _put(self, lane, item, has_space):
+        async with self._changed:
+            # Backpressure: wait for the writer instead of buffering without limit
+            await self._changed.wait_for(has_space)
+            lane.append(item)
+            self._changed.notify_all()
+
+    async def send_control(self, data):
+        await self._put(self._control, data, lambda: len(self._control) < self.max_control)
+
+    async def send_text_delta(self, text):
+        async with self._changed:
+            while True:
+                # A single delta larger than the limit is accepted when no text is pending
+                fits = not self._text_chars or self._text_chars + len(text) <= self.max_text_chars
+                if fits and self._control and isinstance(self._control[-1], list):
+                    self._control[-1].append(text)
+                    self.stats["coalesced"] += 1
+                    break
+                if fits and len(self._control) < self.max_control:
+                    self._control.append([text])
+                    break
+                if self.text_delta_policy == "drop":
+                    self.stats["dropped"] += 1
+                    return
+                await self._changed.wait()
+            self._text_chars += len(text)
+            self._changed.notify_all()
+
+    async def send_audio(self, data):
+        # A single frame larger than the limit (a whole WAV reply) is accepted when the lane is empty
+        def has_space():
+            return not self._audio or self._audio_bytes + len(data) <= self.max_audio_bytes
+        async with self._changed:
+            await self._changed.wait_for(has_space)
+            self._audio.append(data)
+            self._audio_bytes += len(data)
+            self._changed.notify_all()
+
+    async def send_audio_marker(self, data):
+        await self.send_audio(data)
+
+    async def close(self):
+        # No more frames; the writer stops once everything queued is sent
+        async with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def _next_frame(self):
+        if self._control:
+            item = self._control.popleft()
+            if isinstance(item, list):
+                text = "".join(item)
+                self._text_chars -= len(text)
+                return self.framing.text_delta(text)
+            return self.framing.control(item)
+        item = self._audio.popleft()
+        self._audio_bytes -= len(item)
+        # Markers (audio_start, audio_done) travel on the audio lane but are control messages
+        return self.framing.control(item) if isinstance(item, str) else self.framing.audio(item)
+
+    async def run(self):
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._control or self._audio or self._closed)
+                if not (self._control or self._audio):
+                    return
+                frame = self._next_frame()
+                self._changed.notify_all()
+            if self.websocket.client_state != WebSocketState.CONNECTED:
+                return
+            if isinstance(frame, str):
+                await self.websocket.send_text(frame)
+            else:
+                await self.websocket.send_bytes(frame)
+
+    @property
+    def pending(self):
+        return len(self._control) + len(self._audio)
+
+
+class UpstreamSender:
+    # Messages for OpenAI, sent in order by one writer task. Same interface as the websocket
+    # (send), so code that talks to OpenAI does not need to know about the queue.
+    def __init__(self, openai_ws, max_messages=64):
+        self.openai_ws = openai_ws
+        self._queue = asyncio.Queue(maxsize=max_messages)
+        self.queued = 0  # messages ever queued, used to tell whether the session was used
+
+    async def send(self, message):
+        self.queued += 1
+        await self._queue.put(message)
+
+    async def run(self):
+        while True:
+            message = await self._queue.get()
+            await self.openai_ws.send(message)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+
+def queued_to_clients():
+    return sum(sender.pending for sender in _active_senders if isinstance(sender, ClientSender))
+
+
+def queued_to_upstream():
+    return sum(sender.pending for sender in _active_senders if isinstance(sender, UpstreamSender))
+
+
+def create_senders(websocket, openai_ws, framing=None):
+    client_out = ClientSender(
+        websocket,
+        max_audio_bytes=int(os.getenv("RELAY_CLIENT_MAX_AUDIO_BYTES", str(2 * 1024 * 1024))),
+        max_control=int(os.getenv("RELAY_CLIENT_MAX_CONTROL", "256")),
+        text_delta_policy=os.getenv("RELAY_TEXT_DELTA_POLICY", "coalesce"),
+        framing=framing,
+        max_text_chars=int(os.getenv("RELAY_CLIENT_MAX_TEXT_CHARS", str(64 * 1024))),
+    )
+    upstream_out = UpstreamSender(openai_ws, max_messages=int(os.getenv("RELAY_UPSTREAM_MAX_MESSAGES", "64")))
+    return client_out, upstream_out
+
+
+async def run_relay(frontend_reader, openai_reader, client_out, upstream_out, watchers=(), drain_timeout=5):
+    # Run both readers and both writers, plus any watchers (coroutines that end the session when
+    # they return); when any of them ends, the session is over and the others are cancelled.
+    # Unless the client is gone, what is already queued for it is still delivered (within drain_timeout).
+    _active_senders.update((client_out, upstream_out))
+    tasks = {
+        asyncio.create_task(frontend_reader, name="frontend_reader"),
+        asyncio.create_task(openai_reader, name="openai_reader"),
+        asyncio.create_task(client_out.run(), name="client_writer"),
+        asyncio.create_task(upstream_out.run(), name="upstream_writer"),
+    }
+    tasks.update(asyncio.create_task(watcher, name="watcher") for watcher in watchers)
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(f"Relay task {task.get_name()} failed: {task.exception()}")
+        names = {task.get_name() for task in done}
+        if not names & {"frontend_reader", "client_writer"}:
+            await client_out.close()
+            await asyncio.wait([task for task in pending if task.get_name() == "client_writer"], timeout=drain_timeout)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _active_senders.difference_update((client_out, upstream_out))
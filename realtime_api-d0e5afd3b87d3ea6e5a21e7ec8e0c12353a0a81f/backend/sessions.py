@@ -0,0 +1,106 @@
+# sessions.py
+# Session ownership across workers and nodes. Each live session holds a lease in Redis:
+#   {organization}:conversation:{request_id}:lease   token of the connection that owns the session
+# A reconnect with the same request_id (possibly on another worker) takes the lease over; the
+# previous owner notices at its next renewal and ends its relay. The new owner rebuilds the
+# conversation from the history stored in Redis and replays it into the fresh upstream session.
+import os
+import json
+import uuid
+import socket
+import asyncio
+import logging
+import redis
+from storage import conversation_keys
+
+# Identifies this process in lease tokens, which helps when debugging who owns a session
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Extends the lease if we still own it. An expired lease (e.g. after a Redis outage) is taken
+# back, since nobody else claimed it. Returns 0 when another connection owns the session.
+# KEYS: lease  ARGV: token, TTL in ms
+RENEW_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+# Deletes the lease only if we still own it
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lease_key(organization, request_id):
+    return f"{conversation_keys(organization, request_id)[0]}:lease"
+
+
+class SessionLease:
+    def __init__(self, client, organization, request_id, ttl=15.0):
+        self.client = client
+        self.key = lease_key(organization, request_id)
+        self.token = f"{WORKER_ID}:{uuid.uuid4().hex}"
+        self.ttl_ms = int(ttl * 1000)
+        self.previous_owner = None
+        self.held = False  # whether Redis may hold our token, so release() has something to delete
+        self._renew = client.register_script(RENEW_LEASE_SCRIPT)
+        self._release = client.register_script(RELEASE_LEASE_SCRIPT)
+
+    async def acquire(self):
+        # Take the session over, whoever held it. Returns the previous owner's token, if any.
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.key)
+        pipe.set(self.key, self.token, px=self.ttl_ms)
+        self.held = True
+        previous, _ = await pipe.execute()
+        self.previous_owner = previous.decode('utf-8') if isinstance(previous, bytes) else previous
+        return self.previous_owner
+
+    async def keep(self):
+        # Renew the lease until another connection takes it over, then return. Redis errors do
+        # not end the session: ownership is re-checked once Redis answers again.
+        interval = self.ttl_ms / 3000
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await self._renew(keys=[self.key], args=[self.token, self.ttl_ms]):
+                    return
+                self.held = True
+            except redis.RedisError as e:
+                logging.warning(f"Could not renew session lease {self.key}: {e}")
+
+    async def release(self, timeout=1):
+        # Bounded: a lease left behind expires after its TTL anyway
+        if not self.held:
+            return
+        try:
+            await asyncio.wait_for(self._release(keys=[self.key], args=[self.token]), timeout)
+        except (redis.RedisError, asyncio.TimeoutError) as e:
+            logging.warning(f"Could not release session lease {self.key}: {e!r}")
+
+
+# Prefix of the ids given to replayed items, so their conversation.item.created echoes can be told
+# apart from the model's own replies
+REPLAY_ITEM_PREFIX = "replay_"
+
+
+def replay_items(messages):
+    # conversation.item.create events that rebuild a conversation upstream from stored messages
+    events = []
+    for index, message in enumerate(messages):
+        text = message.get('message')
+        if not text:
+            continue
+        item_id = f"{REPLAY_ITEM_PREFIX}{index}"
+        if message.get('sender') == 'user':
+            item = {"id": item_id, "type": "message", "role": "user", "content": [{"type": "input_text", "text": text}]}
+        else:
+            item = {"id": item_id, "type": "message", "role": "assistant", "content": [{"type": "text", "text": text}]}
+        events.append(json.dumps({"type": "conversation.item.create", "item": item}))
+    return events
@@ -0,0 +1,366 @@
+# storage.py
+# Append-only conversation persistence on an async, pooled Redis client.
+#
+# Layout per conversation:
+#   {organization}:conversation:{request_id}        list of encoded messages (see encode_message), appended with RPUSH
+#   {organization}:conversation:{request_id}:meta   hash with 'created', the request/response counters, the stored
+#                                                   size in 'bytes' and the number of messages 'evicted' so far
+#   {organization}:conversation:{request_id}:items  set of upstream item IDs already stored (deduplication)
+#   {organization}:conversation:{request_id}:lease  owner of the live session (see sessions.py)
+# Conversations saved by older versions as one JSON document under the first key are converted on first access.
+#
+# Writes are queued and flushed by a background task in pipelined batches, so a slow Redis
+# never delays audio or text forwarding to the client. Conversations are capped per organization
+# (message count and bytes); the oldest messages are evicted first.
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+from datetime import datetime, timezone
+import redis
+import redis.asyncio as aioredis
+from redis.backoff import ExponentialBackoff
+from redis.asyncio.retry import Retry
+from metrics import REDIS_SECONDS
+
+CONVERSATION_TTL_SECONDS = 86400
+
+# Converts a conversation written by older versions, a JSON document {'metadata', 'messages'}
+# stored with SETEX under the messages key, into the list and meta hash. Messages are pushed as
+# JSON objects, which decode_message still reads. Used by the append script and, when a read
+# hits WRONGTYPE, on its own.
+MIGRATE_LEGACY_FUNCTION = """
+local function migrate_legacy(messages_key, meta_key)
+    if redis.call('TYPE', messages_key).ok ~= 'string' then
+        return 0
+    end
+    local ttl = redis.call('TTL', messages_key)
+    local ok, document = pcall(cjson.decode, redis.call('GET', messages_key))
+    if not ok or type(document) ~= 'table' then
+        return 0
+    end
+    redis.call('DEL', messages_key)
+    local size = 0
+    for _, message in ipairs(document.messages or {}) do
+        local encoded = cjson.encode(message)
+        redis.call('RPUSH', messages_key, encoded)
+        size = size + string.len(encoded)
+    end
+    local metadata = document.metadata or {}
+    if type(metadata.created) == 'string' then
+        redis.call('HSETNX', meta_key, 'created', metadata.created)
+    end
+    redis.call('HINCRBY', meta_key, 'number_of_requests', tonumber(metadata.number_of_requests) or 0)
+    redis.call('HINCRBY', meta_key, 'number_of_responses', tonumber(metadata.number_of_responses) or 0)
+    redis.call('HINCRBY', meta_key, 'bytes', size)
+    if ttl > 0 then
+        redis.call('EXPIRE', messages_key, ttl)
+        redis.call('EXPIRE', meta_key, ttl)
+    end
+    return 1
+end
+"""
+
+# KEYS: messages, meta
+MIGRATE_LEGACY_SCRIPT = MIGRATE_LEGACY_FUNCTION + """
+return migrate_legacy(KEYS[1], KEYS[2])
+"""
+
+# Appends a message unless its item ID was already stored, evicts the oldest messages while the
+# conversation is over its caps (the newest message is always kept) and refreshes the TTL of all three keys.
+# KEYS: messages, meta, items
+# ARGV: encoded message, item ID (or ''), counter field, created timestamp, TTL, max messages, max bytes (0: no cap)
+APPEND_MESSAGE_SCRIPT = MIGRATE_LEGACY_FUNCTION + """
+migrate_legacy(KEYS[1], KEYS[2])
+if ARGV[2] ~= '' and redis.call('SADD', KEYS[3], ARGV[2]) == 0 then
+    return 0
+end
+local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HSETNX', KEYS[2], 'created', ARGV[4])
+redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+local size = redis.call('HINCRBY', KEYS[2], 'bytes', string.len(ARGV[1]))
+local max_messages = tonumber(ARGV[6])
+local max_bytes = tonumber(ARGV[7])
+local evicted = 0
+while length > 1 and ((max_messages > 0 and length > max_messages) or (max_bytes > 0 and size > max_bytes)) do
+    size = size - string.len(redis.call('LPOP', KEYS[1]))
+    length = length - 1
+    evicted = evicted + 1
+end
+if evicted > 0 then
+    redis.call('HSET', KEYS[2], 'bytes', size)
+    redis.call('HINCRBY', KEYS[2], 'evicted', evicted)
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return 1
+"""
+
+# Messages are stored as compact JSON arrays [sender, epoch milliseconds, text] instead of objects
+# with repeated keys; long ones are zlib-compressed and prefixed with b'z'. Objects written by
+# older versions are still read.
+SENDERS = ('user', 'bot')
+COMPRESS_MIN_BYTES = 512
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def encode_message(message):
+    timestamp = datetime.fromisoformat(message['timestamp'])
+    sender = SENDERS.index(message['sender']) if message['sender'] in SENDERS else message['sender']
+    data = json.dumps(
+        [sender, round(timestamp.timestamp() * 1000), message['message']], separators=(',', ':'), ensure_ascii=False,
+    ).encode('utf-8')
+    if len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data)
+        if len(compressed) + 1 < len(data):
+            return b'z' + compressed
+    return data
+
+
+def decode_message(data):
+    if data[:1] == b'z':
+        data = zlib.decompress(data[1:])
+    elif data[:1] == b'{':
+        return json.loads(data)
+    sender, timestamp_ms, text = json.loads(data)
+    return {
+        'sender': SENDERS[sender] if isinstance(sender, int) else sender,
+        'message': text,
+        'timestamp': datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc).isoformat(),
+    }
+
+
+def conversation_keys(organization, request_id):
+    base = f"{organization}:conversation:{request_id}"
+    return base, f"{base}:meta", f"{base}:items"
+
+
+def create_async_redis():
+    # Connection pool, timeouts and retries are configured from the environment
+    redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+    redis_password = os.getenv('REDIS_PASSWORD', None)
+    if redis_password:
+        scheme, rest = redis_url.split("://", 1)
+        redis_url = f"{scheme}://:{redis_password}@{rest}"
+    timeout = float(os.getenv('REDIS_TIMEOUT', '2'))
+    return aioredis.from_url(
+        redis_url,
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+        retry=Retry(ExponentialBackoff(cap=1.0, base=0.05), int(os.getenv('REDIS_RETRIES', '3'))),
+        retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+        health_check_interval=30,
+    )
+
+
+def no_history_limits(organization):
+    return 0, 0
+
+
+class ConversationStore:
+    def __init__(self, client, expire_seconds=CONVERSATION_TTL_SECONDS, batch_size=64, max_queue=10000, history_limits=no_history_limits):
+        self.client = client
+        self.expire_seconds = expire_seconds
+        self.batch_size = batch_size
+        # organization -> (max messages, max bytes) kept per conversation, 0 for no cap
+        self.history_limits = history_limits
+        self._append_script = client.register_script(APPEND_MESSAGE_SCRIPT)
+        self._migrate_script = client.register_script(MIGRATE_LEGACY_SCRIPT)
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        # (organization, request_id) -> [queued writes, event set once they are all written], so a
+        # reader waits for its own conversation and not for the whole queue
+        self._pending = {}
+        self._writer = None
+        self.healthy = None  # unknown until the first health check
+        self.stats = {"written": 0, "duplicates": 0, "dropped": 0, "failed": 0}
+
+    async def check_health(self):
+        # Ping Redis and log transitions; the pool reconnects by itself on the next command
+        try:
+            await self.client.ping()
+            healthy = True
+        except redis.RedisError as e:
+            healthy = False
+            if self.healthy is not False:
+                logging.error(f"Redis connection error: {e}")
+        if healthy and self.healthy is not True:
+            logging.info("Successfully connected to Redis.")
+        self.healthy = healthy
+        return healthy
+
+    async def monitor_health(self, interval=15):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(interval)
+
+    def append(self, organization, request_id, message, item_id=None):
+        # Queue one message for the background writer and return immediately.
+        # The cost of a write no longer depends on the length of the conversation.
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_loop())
+        try:
+            self._queue.put_nowait((organization, request_id, message, item_id))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logging.error(f"Conversation write queue is full, dropping message for {organization}:{request_id}")
+            return
+        pending = self._pending.setdefault((organization, request_id), [0, asyncio.Event()])
+        pending[0] += 1
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write_batch(batch)
+            except redis.RedisError as e:
+                self.stats["failed"] += len(batch)
+                logging.error(f"Failed to save conversation to Redis: {e}")
+            except Exception as e:
+                self.stats["failed"] += len(batch)
+                logging.error(f"Unexpected error while saving conversation: {e}")
+            finally:
+                for organization, request_id, _, _ in batch:
+                    self._queue.task_done()
+                    self._written((organization, request_id))
+
+    def _written(self, key):
+        # One queued write of this conversation was handled (stored or failed)
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        pending[0] -= 1
+        if pending[0] <= 0:
+            pending[1].set()
+            del self._pending[key]
+
+    async def _write_batch(self, batch):
+        # One pipelined round trip for the whole batch
+        pipe = self.client.pipeline(transaction=False)
+        for organization, request_id, message, item_id in batch:
+            counter = 'number_of_requests' if message.get('sender') == 'user' else 'number_of_responses'
+            max_messages, max_bytes = self.history_limits(organization)
+            await self._append_script(
+                keys=conversation_keys(organization, request_id),
+                args=[
+                    encode_message(message), item_id or '', counter, message['timestamp'], self.expire_seconds,
+                    max_messages, max_bytes,
+                ],
+                client=pipe,
+            )
+        started = time.perf_counter()
+        results = await pipe.execute()
+        REDIS_SECONDS.labels("append_batch").observe(time.perf_counter() - started)
+        stored = sum(1 for result in results if result)
+        self.stats["written"] += stored
+        self.stats["duplicates"] += len(results) - stored
+        logging.debug("Appended %d message(s) to Redis (%d duplicate(s) skipped)", stored, len(results) - stored)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    async def flush(self, timeout=None):
+        # Wait until every queued write has reached Redis (used on shutdown)
+        await asyncio.wait_for(self._queue.join(), timeout)
+
+    async def flush_conversation(self, organization, request_id, timeout=None):
+        # Wait until this conversation's queued writes have reached Redis (used before reads).
+        # Returns immediately when it has none, and False if they are still pending after timeout.
+        pending = self._pending.get((organization, request_id))
+        if pending is None:
+            return True
+        try:
+            await asyncio.wait_for(pending[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def load(self, organization, request_id):
+        # Rebuild the {'metadata': ..., 'messages': [...]} document served to the frontend, or None
+        return await self.load_page(organization, request_id, 0, 0)
+
+    async def _read(self, organization, request_id, read):
+        # Runs read(); a conversation still stored in the old single-document format is converted
+        # first when Redis reports WRONGTYPE, then read again
+        try:
+            return await read()
+        except redis.ResponseError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+        messages_key, meta_key, _ = conversation_keys(organization, request_id)
+        if await self._migrate_script(keys=[messages_key, meta_key]):
+            logging.info(f"Converted conversation {messages_key} from the old storage format")
+        return await read()
+
+    async def load_page(self, organization, request_id, cursor, limit):
+        return await self._read(organization, request_id, lambda: self._load_page(organization, request_id, cursor, limit))
+
+    async def _load_page(self, organization, request_id, cursor, limit):
+        # Up to `limit` messages (0: all) starting at message number `cursor`, counted from the
+        # first message ever stored so cursors stay valid while old messages are evicted.
+        # The metadata says where the page starts ('offset') and where the next one does ('next', None at the end).
+        messages_key, meta_key, _ = conversation_keys(organization, request_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(meta_key)
+        pipe.llen(messages_key)
+        started = time.perf_counter()
+        raw_meta, length = await pipe.execute()
+        meta = {_decode(k): _decode(v) for k, v in raw_meta.items()}
+        evicted = int(meta.get('evicted', 0))
+        start = max(cursor - evicted, 0)
+        end = length - 1 if limit <= 0 else start + limit - 1
+        raw_messages = await self.client.lrange(messages_key, start, end) if start < length else []
+        REDIS_SECONDS.labels("load").observe(time.perf_counter() - started)
+        if not length:
+            return None
+
+        messages = [decode_message(m) for m in raw_messages]
+        next_start = start + len(messages)
+        metadata = {
+            'created': meta.get('created') or (messages[0]['timestamp'] if messages else None),
+            'downloaded': datetime.now(timezone.utc).isoformat(),
+            'number_of_requests': int(meta.get('number_of_requests', 0)),
+            'number_of_responses': int(meta.get('number_of_responses', 0)),
+            'offset': evicted + start,
+            'next': evicted + next_start if next_start < length else None,
+            'evicted': evicted,
+        }
+        return {'metadata': metadata, 'messages': messages}
+
+    async def load_recent(self, organization, request_id, count):
+        # The last `count` messages of a conversation, oldest first
+        if count <= 0:
+            return []
+        messages_key, _, _ = conversation_keys(organization, request_id)
+        started = time.perf_counter()
+        raw_messages = await self._read(organization, request_id, lambda: self.client.lrange(messages_key, -count, -1))
+        REDIS_SECONDS.labels("load_recent").observe(time.perf_counter() - started)
+        return [decode_message(m) for m in raw_messages]
+
+    async def close(self, timeout=5):
+        try:
+            await self.flush(timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Timed out flushing {self._queue.qsize()} pending conversation write(s)")
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        await self.client.aclose()
+
+
+def create_conversation_store(history_limits=no_history_limits):
+    return ConversationStore(
+        create_async_redis(),
+        history_limits=history_limits,
+        batch_size=int(os.getenv('REDIS_WRITE_BATCH_SIZE', '64')),
+        max_queue=int(os.getenv('REDIS_WRITE_QUEUE_SIZE', '10000')),
+    )
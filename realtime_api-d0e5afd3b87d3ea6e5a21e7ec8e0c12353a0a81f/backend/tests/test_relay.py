@@ -0,0 +1,65 @@
+# tests/test_relay.py
+# Bounds of the per-session client queue (relay.ClientSender) under a slow or stalled browser.
+# Run from the backend directory: python -m pytest tests
+import asyncio
+import json
+from starlette.websockets import WebSocketState
+from relay import ClientSender
+
+
+class SlowClient:
+    # Browser websocket whose sends block until the test lets them through
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.frames = []
+        self.open = asyncio.Event()
+
+    async def send_text(self, data):
+        await self.open.wait()
+        self.frames.append(data)
+
+    async def send_bytes(self, data):
+        await self.open.wait()
+        self.frames.append(data)
+
+
+def pending_text(sender):
+    return sum(len(delta) for item in sender._control if isinstance(item, list) for delta in item)
+
+
+def test_drop_policy_bounds_text_deltas_with_stalled_writer():
+    async def scenario():
+        client = SlowClient()
+        sender = ClientSender(client, max_control=4, text_delta_policy="drop", max_text_chars=1000)
+        writer = asyncio.create_task(sender.run())
+        for _ in range(100_000):
+            await sender.send_text_delta("token ")
+        assert pending_text(sender) <= 1000
+        assert sender.stats["dropped"] > 0
+        writer.cancel()
+    asyncio.run(scenario())
+
+
+def test_coalesce_policy_waits_for_writer_and_keeps_every_delta():
+    async def scenario():
+        client = SlowClient()
+        sender = ClientSender(client, max_control=4, text_delta_policy="coalesce", max_text_chars=100)
+        writer = asyncio.create_task(sender.run())
+
+        async def produce():
+            for i in range(1000):
+                await sender.send_text_delta(f"{i % 10}")
+        producer = asyncio.create_task(produce())
+        await asyncio.sleep(0.05)
+        # The writer is stalled: the producer waits instead of queuing all 1000 deltas
+        assert not producer.done()
+        assert pending_text(sender) <= 100
+
+        client.open.set()
+        await asyncio.wait_for(producer, 5)
+        await sender.close()
+        await asyncio.wait_for(writer, 5)
+        text = "".join(json.loads(frame)["text"] for frame in client.frames)
+        assert text == "".join(f"{i % 10}" for i in range(1000))
+        assert sender.stats["dropped"] == 0
+    asyncio.run(scenario())
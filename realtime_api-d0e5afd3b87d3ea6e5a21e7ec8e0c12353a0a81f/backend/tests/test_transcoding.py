@@ -0,0 +1,68 @@
+# tests/test_transcoding.py
+# Admission limits of the transcoding pool: one organization's backlog must not get other
+# organizations' uploads rejected.
+# Run from the backend directory: python -m pytest tests
+import time
+import asyncio
+import threading
+import pytest
+import transcoding
+from transcoding import TranscodeOverloaded, TranscodePool
+
+
+def test_busy_organization_cannot_fill_the_shared_queue(monkeypatch):
+    release = threading.Event()
+
+    def slow_transcode(raw_audio):
+        release.wait(5)
+        now = time.monotonic()
+        return raw_audio, now, now
+    monkeypatch.setattr(transcoding, "_timed_process_audio", slow_transcode)
+
+    async def scenario():
+        pool = TranscodePool(max_workers=2, max_queue=4, default_org_concurrency=1, max_org_queue=2)
+        busy = [asyncio.create_task(pool.transcode("busy", b"x")) for _ in range(6)]
+        await asyncio.sleep(0.05)
+        # 1 running + 2 waiting for the organization's own limit; the other 3 are turned away
+        rejected = [task for task in busy if task.done() and isinstance(task.exception(), TranscodeOverloaded)]
+        assert len(rejected) == 3
+        assert pool.pending == 3
+
+        # Another organization still gets in
+        other = asyncio.create_task(pool.transcode("other", b"y"))
+        await asyncio.sleep(0.05)
+        assert not other.done()
+        release.set()
+        result, _ = await asyncio.wait_for(other, 5)
+        assert result == b"y"
+        await asyncio.gather(*busy, return_exceptions=True)
+        assert pool.pending == 0 and pool.stats["rejected"] == 3
+        pool.shutdown()
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+
+
+def test_shared_queue_limit_still_applies(monkeypatch):
+    release = threading.Event()
+
+    def slow_transcode(raw_audio):
+        release.wait(5)
+        now = time.monotonic()
+        return raw_audio, now, now
+    monkeypatch.setattr(transcoding, "_timed_process_audio", slow_transcode)
+
+    async def scenario():
+        pool = TranscodePool(max_workers=1, max_queue=1, default_org_concurrency=1, max_org_queue=2)
+        jobs = [asyncio.create_task(pool.transcode(f"org{i}", b"x")) for i in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(TranscodeOverloaded):
+            await pool.transcode("org2", b"x")
+        release.set()
+        await asyncio.gather(*jobs)
+        pool.shutdown()
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
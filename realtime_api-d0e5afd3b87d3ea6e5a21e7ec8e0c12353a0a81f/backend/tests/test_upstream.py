@@ -0,0 +1,117 @@
+# tests/test_upstream.py
+# UpstreamPool against the mock Realtime server of tools/loadtest.py: warm hits, recycling of
+# used sessions, eviction on a config change, idle expiry and the ping path.
+# Run from the backend directory: python -m pytest tests
+import asyncio
+import websockets
+from config import parse_config
+from tools.loadtest import MockRealtime
+from upstream import UpstreamPool
+
+
+def organization(instructions="Pool test", pool_size=1):
+    return parse_config({"pooltest": {
+        "prompts": {"instructions": instructions},
+        "turn_detection": None,
+        "tools": [],
+        "tool_choice": "none",
+        "upstream_pool_size": pool_size,
+    }})["pooltest"]
+
+
+def run_with_mock(scenario, **pool_options):
+    async def main():
+        mock = MockRealtime(first_delta_ms=0, response_ms=100, chunk_ms=100, delta_interval_ms=0)
+        server = await websockets.serve(mock.handle, "127.0.0.1", 0)
+        url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        pool = UpstreamPool(url, {}, connect_timeout=5, **pool_options)
+        try:
+            await scenario(pool, mock)
+        finally:
+            await pool.close()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(main())
+
+
+def test_warm_hit_uses_the_pre_connected_session():
+    async def scenario(pool, mock):
+        org_config = organization()
+        await pool.maintain([org_config])
+        assert pool.idle_count("pooltest") == 1
+        assert mock.connections == 1
+
+        ws = await pool.acquire(org_config)
+        assert pool.stats["hits"] == 1 and pool.stats["misses"] == 0
+        assert mock.connections == 1
+        assert pool.idle_count("pooltest") == 0
+        await pool.release(org_config, ws, reusable=True)
+        assert pool.idle_count("pooltest") == 1
+    run_with_mock(scenario)
+
+
+def test_used_session_is_recycled():
+    async def scenario(pool, mock):
+        org_config = organization()
+        await pool.maintain([org_config])
+        ws = await pool.acquire(org_config)
+        await ws.send('{"type": "response.create"}')
+        # The client used the session: it is closed, not put back, and a fresh one replaces it
+        await pool.release(org_config, ws, reusable=False)
+        assert ws.closed
+        assert pool.idle_count("pooltest") == 0
+        await pool.maintain([org_config])
+        assert pool.idle_count("pooltest") == 1
+        assert mock.connections == 2
+    run_with_mock(scenario)
+
+
+def test_config_change_evicts_stale_sessions():
+    async def scenario(pool, mock):
+        await pool.maintain([organization("Old instructions", pool_size=2)])
+        assert pool.idle_count("pooltest") == 2
+        changed = organization("New instructions", pool_size=2)
+
+        # acquire() never hands out a session configured with the old session.update
+        ws = await pool.acquire(changed)
+        assert pool.stats["evicted"] == 2 and pool.stats["misses"] == 1 and pool.stats["hits"] == 0
+        await ws.close()
+
+        # maintain() replaces sessions of an outdated config with fresh ones
+        await pool.maintain([organization("Old instructions", pool_size=2)])
+        await pool.maintain([changed])
+        assert pool.stats["evicted"] == 4
+        assert pool.idle_count("pooltest") == 2
+        await pool.acquire(changed)
+        assert pool.stats["hits"] == 1
+        assert mock.connections == 7
+    run_with_mock(scenario)
+
+
+def test_idle_and_dead_sessions_are_evicted():
+    async def scenario(pool, mock):
+        org_config = organization(pool_size=0)
+        ws = await pool.acquire(org_config)
+        await pool.release(organization(pool_size=1), ws, reusable=True)
+        assert pool.idle_count("pooltest") == 1
+        # Pinged and kept while alive
+        await pool.maintain([org_config])
+        assert pool.idle_count("pooltest") == 1 and pool.stats["evicted"] == 0
+        # A session whose connection died is dropped by the next pass
+        await ws.close()
+        await pool.maintain([org_config])
+        assert pool.idle_count("pooltest") == 0 and pool.stats["evicted"] == 1
+    run_with_mock(scenario)
+
+
+def test_sessions_idle_for_too_long_are_closed():
+    async def scenario(pool, mock):
+        org_config = organization()
+        await pool.maintain([org_config])
+        ws = pool._idle["pooltest"][0].ws
+        await asyncio.sleep(0.05)
+        await pool.maintain([org_config])
+        assert ws.closed
+        assert pool.stats["evicted"] == 1
+        assert pool.idle_count("pooltest") == 1
+    run_with_mock(scenario, max_idle_seconds=0.01)
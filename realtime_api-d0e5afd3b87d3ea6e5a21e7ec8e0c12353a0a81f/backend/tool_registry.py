@@ -0,0 +1,140 @@
+# tool_registry.py
+# Implementations of the function tools the model can call. Each organization only gets the tools
+# listed in its config.json "tools"; calls run concurrently off the relay loop with a timeout,
+# and successful results can be cached for a while keyed on the tool and its arguments.
+import json
+import time
+import asyncio
+import logging
+import inspect
+from collections import OrderedDict
+from metrics import TOOL_SECONDS
+
+
+class ResultCache:
+    # LRU of tool results, each entry expiring after the ttl it was stored with
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires at, result)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, result, ttl):
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Tool:
+    def __init__(self, name, func, timeout, cache_ttl, max_concurrency):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        # Plain functions are run in a thread so a slow backend never blocks the event loop
+        self.is_async = inspect.iscoroutinefunction(func)
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def invoke(self, arguments):
+        if self.is_async:
+            return await self.func(**arguments)
+        return await asyncio.to_thread(self.func, **arguments)
+
+
+class ToolRegistry:
+    def __init__(self, cache_size=1024):
+        self._tools = {}
+        self.cache = ResultCache(cache_size)
+        self.inflight = {}  # cache key -> task, so identical concurrent calls share one execution
+
+    def register(self, name=None, timeout=10.0, cache_ttl=0, max_concurrency=None):
+        # Decorator; cache_ttl=0 disables caching, max_concurrency bounds calls across all sessions
+        def decorator(func):
+            tool_name = name or func.__name__
+            self._tools[tool_name] = Tool(tool_name, func, timeout, cache_ttl, max_concurrency)
+            return func
+        return decorator
+
+    def get(self, name):
+        return self._tools.get(name)
+
+    def names(self):
+        return list(self._tools)
+
+    def for_organization(self, org_config):
+        return OrganizationTools(self, org_config)
+
+
+class OrganizationTools:
+    # The registry as seen by one organization: only its configured tools, with the timeout and
+    # cache_ttl overrides from its "tool_settings"
+    def __init__(self, registry, org_config):
+        self.registry = registry
+        self.organization = org_config.name
+        self.enabled = {tool["name"] for tool in org_config.settings.get("tools", ())}
+        self.tool_settings = org_config.settings.get("tool_settings", {})
+
+    async def call(self, name, arguments):
+        # Result to send back as function_call_output; failures become {"error": ...}
+        tool = self.registry.get(name) if name in self.enabled else None
+        if tool is None:
+            return {"error": f"Function '{name}' not found."}
+        settings = self.tool_settings.get(name, {})
+        timeout = settings.get("timeout", tool.timeout)
+        cache_ttl = settings.get("cache_ttl", tool.cache_ttl)
+
+        if cache_ttl <= 0:
+            result, _ = await self._run(tool, arguments, timeout)
+            return result
+
+        started = time.perf_counter()
+        key = (self.organization, name, json.dumps(arguments, sort_keys=True, separators=(",", ":")))
+        result = self.registry.cache.get(key)
+        if result is not None:
+            TOOL_SECONDS.labels(name, "cached").observe(time.perf_counter() - started)
+            return result
+        task = self.registry.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(tool, arguments, timeout))
+            self.registry.inflight[key] = task
+            task.add_done_callback(lambda _: self.registry.inflight.pop(key, None))
+        # Shielded: one session going away must not cancel the call for the others waiting on it
+        result, outcome = await asyncio.shield(task)
+        if outcome == "ok":
+            self.registry.cache.put(key, result, cache_ttl)
+        return result
+
+    async def _run(self, tool, arguments, timeout):
+        # (result, outcome); the result is an {"error": ...} object unless the outcome is "ok"
+        name = tool.name
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            if tool.semaphore is not None:
+                async with tool.semaphore:
+                    result = await asyncio.wait_for(tool.invoke(arguments), timeout)
+            else:
+                result = await asyncio.wait_for(tool.invoke(arguments), timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logging.warning(f"Tool {name} timed out after {timeout}s")
+            return {"error": f"Function '{name}' timed out."}, outcome
+        except Exception as e:
+            outcome = "error"
+            logging.error(f"Tool {name} failed: {e}")
+            return {"error": f"Function '{name}' failed: {e}"}, outcome
+        finally:
+            TOOL_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+        return result, outcome
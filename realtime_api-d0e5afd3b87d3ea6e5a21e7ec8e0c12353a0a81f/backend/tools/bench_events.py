@@ -0,0 +1,103 @@
+# tools/bench_events.py
+# Micro-benchmark of OpenAI event handling: parsing alone (json.loads vs the delta fast path)
+# and the whole per-event path (parse, session log, dispatch, metrics) with a client that
+# accepts frames instantly. Single-threaded, so events/s is per core.
+#
+# Run from the backend directory:  python -m tools.bench_events [--events 50000]
+import json
+import time
+import base64
+import asyncio
+import logging
+import argparse
+from events import parse_event
+from event_log import SessionLog
+from metrics import SessionMetrics, observe_event
+import main
+
+AUDIO_CHUNK_BYTES = 4800  # 100 ms of 24kHz mono PCM16, a typical response.audio.delta
+
+
+def sample_events():
+    ids = '"event_id":"event_AbCdEf123","response_id":"resp_AbCdEf123","item_id":"item_AbCdEf123","output_index":0,"content_index":0'
+    audio = base64.b64encode(bytes(AUDIO_CHUNK_BYTES)).decode('ascii')
+    return {
+        "response.audio.delta": f'{{"type":"response.audio.delta",{ids},"delta":"{audio}"}}',
+        "response.text.delta": f'{{"type":"response.text.delta",{ids},"delta":"Hello there, "}}',
+        "response.audio_transcript.delta": f'{{"type":"response.audio_transcript.delta",{ids},"delta":"Hello"}}',
+        "response.done": json.dumps({"type": "response.done", "event_id": "event_1", "response": {
+            "id": "resp_1", "status": "completed", "output": [],
+            "usage": {"total_tokens": 30, "input_tokens": 12, "output_tokens": 18},
+        }}),
+    }
+
+
+class NullClient:
+    # Stands in for relay.ClientSender; every frame is accepted immediately
+    async def send_control(self, data):
+        pass
+
+    async def send_text_delta(self, text):
+        pass
+
+    async def send_audio(self, data):
+        pass
+
+    async def send_audio_marker(self, data):
+        pass
+
+
+class BenchConfig:
+    name = "bench"
+    settings = {"audio_output_mode": "stream", "audio_stream_format": "pcm16"}
+
+
+def rate(count, wall, cpu):
+    return f"{count / wall:>12,.0f} events/s  {count / cpu:>12,.0f} events/cpu-s  {wall / count * 1e6:8.2f} us/event"
+
+
+def bench_parse(messages, count):
+    for event_type, message in messages.items():
+        for name, parse in (("json.loads", json.loads), ("parse_event", parse_event)):
+            wall, cpu = time.perf_counter(), time.process_time()
+            for _ in range(count):
+                parse(message)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            print(f"  {event_type:<34} {name:<12} {rate(count, wall, cpu)}")
+
+
+async def bench_dispatch(messages, count):
+    # Same steps as main.handle_openai_to_frontend for each message
+    with SessionMetrics("bench") as session_metrics:
+        session_log = SessionLog("bench", "bench")
+        session = main.OpenAIEventSession(
+            NullClient(), None, "bench", "bench", BenchConfig(), session_log, session_metrics,
+        )
+        for event_type, message in messages.items():
+            wall, cpu = time.perf_counter(), time.process_time()
+            for _ in range(count):
+                started = time.perf_counter()
+                parsed_type, event = parse_event(message)
+                session_log.event("openai", parsed_type, event, size=len(message))
+                await main.openai_events.dispatch(session, parsed_type, event)
+                observe_event("openai", parsed_type, started)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            print(f"  {event_type:<34} {rate(count, wall, cpu)}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark OpenAI event handling")
+    parser.add_argument("--events", type=int, default=50000, help="events per measurement")
+    args = parser.parse_args()
+    # Per-response INFO logs (usage statistics) would dominate the measurement
+    logging.getLogger("relay").setLevel(logging.WARNING)
+    messages = sample_events()
+
+    print(f"Parsing ({args.events} events each):")
+    bench_parse(messages, args.events)
+    print(f"Full handling path ({args.events} events each):")
+    asyncio.run(bench_dispatch(messages, args.events))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,408 @@
+# tools/loadtest.py
+# Load generator for the relay. Starts a local mock of the OpenAI Realtime WebSocket that streams
+# realistic delta sequences at a configurable pace, runs the backend (main:app) in a separate
+# process pointed at it, and drives N concurrent synthetic frontend clients through
+# /gpt-api/chat_stream/... sending text, raw PCM16, WAV or WebM turns. Reports time to first
+# byte/audio (p50/p99), throughput, and the backend's CPU and memory per session.
+#
+# Run from the backend directory:
+#   python -m tools.loadtest --sessions 50 --turns 5 --mix text=1,pcm=1,wav=1
+#   python -m tools.loadtest --sessions 20 --redis redis://localhost:6379 --json baseline.json
+#   python -m tools.loadtest --sessions 20 --upstream-pool-size 10 --ramp 10
+# Without --redis the backend uses an in-memory fake Redis, which has to run the Lua scripts of
+# storage.py and sessions.py: install it with Lua support, pip install "fakeredis[lua]".
+# CPU and memory are read from /proc and are only reported on Linux.
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import websockets
+from audio import pcm_to_wav
+
+SAMPLE_RATE = 24000
+
+
+def synthetic_pcm(seconds, frequency=220.0):
+    # A quiet sine tone; content does not matter to the relay, only its size
+    count = int(SAMPLE_RATE * seconds)
+    samples = (int(8000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)) for i in range(count))
+    return b"".join(sample.to_bytes(2, "little", signed=True) for sample in samples)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+# --- Mock OpenAI Realtime server -----------------------------------------------------------------
+
+class MockRealtime:
+    # Answers every response.create with the event sequence of a spoken reply: response.created,
+    # the assistant item, interleaved transcript and audio deltas, then the done events.
+    def __init__(self, first_delta_ms, response_ms, chunk_ms, delta_interval_ms):
+        self.first_delta_ms = first_delta_ms
+        self.response_ms = response_ms
+        self.chunk_ms = chunk_ms
+        self.delta_interval_ms = delta_interval_ms
+        chunk = synthetic_pcm(chunk_ms / 1000)
+        self.audio_delta = base64.b64encode(chunk).decode("ascii")
+        self.responses = 0
+        self.connections = 0
+
+    async def handle(self, ws, *args):
+        self.connections += 1
+        async for message in ws:
+            event = json.loads(message)
+            event_type = event.get("type")
+            if event_type == "session.update":
+                await ws.send(json.dumps({"type": "session.updated", "session": event.get("session", {})}))
+            elif event_type == "response.create":
+                await self.respond(ws)
+
+    async def respond(self, ws):
+        self.responses += 1
+        ids = {"response_id": f"resp_{uuid.uuid4().hex[:12]}", "item_id": f"item_{uuid.uuid4().hex[:12]}"}
+        item = {"id": ids["item_id"], "type": "message", "role": "assistant", "content": []}
+        await ws.send(json.dumps({"type": "response.created", "response": {"id": ids["response_id"]}}))
+        await ws.send(json.dumps({"type": "conversation.item.created", "item": item}))
+        await asyncio.sleep(self.first_delta_ms / 1000)
+
+        words = []
+        for index in range(max(int(self.response_ms / self.chunk_ms), 1)):
+            word = f"word{index} "
+            words.append(word)
+            # Compact JSON with "type" first, as OpenAI sends it
+            await ws.send(
+                f'{{"type":"response.audio_transcript.delta","event_id":"event_{index}a",'
+                f'"response_id":"{ids["response_id"]}","item_id":"{ids["item_id"]}","output_index":0,'
+                f'"content_index":0,"delta":"{word}"}}'
+            )
+            await ws.send(
+                f'{{"type":"response.audio.delta","event_id":"event_{index}b",'
+                f'"response_id":"{ids["response_id"]}","item_id":"{ids["item_id"]}","output_index":0,'
+                f'"content_index":0,"delta":"{self.audio_delta}"}}'
+            )
+            if self.delta_interval_ms:
+                await asyncio.sleep(self.delta_interval_ms / 1000)
+
+        transcript = "".join(words)
+        await ws.send(json.dumps({"type": "response.audio.done", **ids}))
+        await ws.send(json.dumps({"type": "response.audio_transcript.done", "transcript": transcript, **ids}))
+        item["content"] = [{"type": "audio", "transcript": transcript}]
+        await ws.send(json.dumps({"type": "response.output_item.done", "item": item, **ids}))
+        await ws.send(json.dumps({"type": "response.done", "response": {
+            "id": ids["response_id"], "status": "completed",
+            "usage": {"total_tokens": 120, "input_tokens": 40, "output_tokens": 80},
+        }}))
+
+
+# --- Backend process -----------------------------------------------------------------------------
+
+def serve_backend(port, fake_redis):
+    # Entry point of the backend subprocess
+    if fake_redis:
+        import fakeredis
+        try:
+            import lupa  # noqa: F401
+        except ImportError:
+            # Without it every history write and lease renewal fails and the numbers are meaningless
+            raise SystemExit('The fake Redis needs Lua support: pip install "fakeredis[lua]"')
+        import redis.asyncio
+        server = fakeredis.FakeServer()
+        redis.asyncio.from_url = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=server)
+    import uvicorn
+    uvicorn.run("main:app", host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_backend(args, mock_url):
+    config = {
+        "loadtest": {
+            "prompts": {"instructions": "Load test"},
+            "turn_detection": None,
+            "tools": [],
+            "tool_choice": "none",
+            "audio_output_mode": args.audio_output_mode,
+            "upstream_pool_size": args.upstream_pool_size,
+        }
+    }
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    port = free_port()
+    env = dict(os.environ, OPENAI_WS_URL=mock_url, CONFIG_PATH=config_file.name, LOG_LEVEL="WARNING",
+               UPSTREAM_POOL_PING_INTERVAL=str(args.pool_interval))
+    if args.redis:
+        env["REDIS_URL"] = args.redis
+    command = [sys.executable, "-m", "tools.loadtest", "--serve-backend", str(port)]
+    if not args.redis:
+        command.append("--fake-redis")
+    process = subprocess.Popen(command, env=env)
+    return process, port, config_file.name
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"Backend did not start listening on port {port}")
+
+
+class ProcessSampler:
+    # CPU seconds and peak RSS of a process, from /proc (Linux only)
+    def __init__(self, pid):
+        self.pid = pid
+        self.available = os.path.exists(f"/proc/{pid}/stat")
+        self.peak_rss = 0
+
+    def cpu_seconds(self):
+        if not self.available:
+            return float("nan")
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss_bytes(self):
+        if not self.available:
+            return 0
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def run(self, interval=0.2):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+            await asyncio.sleep(interval)
+
+
+# --- Synthetic clients ---------------------------------------------------------------------------
+
+class Results:
+    def __init__(self):
+        self.ttfb = []   # seconds from the end of the user's input to the first response frame
+        self.ttfa = []   # seconds from the end of the user's input to the first audio frame
+        self.turns = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.max_concurrent = 0
+        self._concurrent = 0
+
+    def session_started(self):
+        self._concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self._concurrent)
+
+    def session_ended(self):
+        self._concurrent -= 1
+
+
+def parse_mix(value):
+    mix = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        kind, _, weight = entry.partition("=")
+        mix[kind.strip()] = float(weight or 1)
+    unknown = set(mix) - {"text", "pcm", "wav", "webm"}
+    if unknown:
+        raise SystemExit(f"Unknown input kinds in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+async def run_turn(ws, kind, payloads, results, timeout):
+    if kind == "text":
+        await ws.send(json.dumps({"text": "What is the weather like today?"}))
+    else:
+        await ws.send(payloads[kind])
+    sent_at = time.perf_counter()
+    first_byte = first_audio = None
+    while True:
+        frame = await asyncio.wait_for(ws.recv(), timeout)
+        now = time.perf_counter()
+        results.frames_received += 1
+        results.bytes_received += len(frame)
+        if isinstance(frame, bytes):
+            first_byte = first_byte or now
+            first_audio = first_audio or now
+            continue
+        if frame.startswith('{"text_done"'):
+            continue
+        if '"error"' in frame:
+            raise RuntimeError(frame)
+        first_byte = first_byte or now
+        if '"audio_start"' in frame:
+            first_audio = first_audio or now
+        if '"audio_done"' in frame:
+            break
+    results.ttfb.append(first_byte - sent_at)
+    if first_audio is not None:
+        results.ttfa.append(first_audio - sent_at)
+    results.turns += 1
+
+
+async def run_session(args, base_url, mix, payloads, results, start_delay):
+    await asyncio.sleep(start_delay)
+    kinds, weights = zip(*mix.items())
+    # Raw PCM needs to be announced on connect; WAV is still recognized by its header
+    query = "?input_format=pcm16&sample_rate=24000&channels=1" if "pcm" in mix else ""
+    url = f"{base_url}/gpt-api/chat_stream/loadtest/{uuid.uuid4().hex}{query}"
+    results.session_started()
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            for _ in range(args.turns):
+                kind = random.choices(kinds, weights)[0]
+                try:
+                    await run_turn(ws, kind, payloads, results, args.turn_timeout)
+                except (asyncio.TimeoutError, RuntimeError) as e:
+                    results.errors += 1
+                    if args.verbose:
+                        print(f"turn failed ({kind}): {e!r}", file=sys.stderr)
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000)
+    except (OSError, websockets.WebSocketException) as e:
+        results.errors += 1
+        if args.verbose:
+            print(f"session failed: {e!r}", file=sys.stderr)
+    finally:
+        results.session_ended()
+
+
+# --- Driver --------------------------------------------------------------------------------------
+
+def build_payloads(args, mix):
+    pcm = synthetic_pcm(args.input_seconds)
+    payloads = {"pcm": pcm, "wav": pcm_to_wav(pcm)}
+    if "webm" in mix:
+        if not args.webm_file:
+            raise SystemExit("--mix includes webm: pass a recording with --webm-file")
+        with open(args.webm_file, "rb") as f:
+            payloads["webm"] = f.read()
+    if "pcm" in mix and "webm" in mix:
+        # A session that negotiated pcm16 treats every frame without a WAV header as raw PCM
+        raise SystemExit("pcm and webm turns cannot be mixed; run them separately")
+    return payloads
+
+
+def report(args, results, wall, cpu, baseline_rss, peak_rss, mock):
+    sessions = args.sessions
+    summary = {
+        "sessions": sessions,
+        "max_concurrent_sessions": results.max_concurrent,
+        "turns": results.turns,
+        "errors": results.errors,
+        "wall_seconds": round(wall, 3),
+        "ttfb_p50_ms": round(percentile(results.ttfb, 0.50) * 1000, 2),
+        "ttfb_p99_ms": round(percentile(results.ttfb, 0.99) * 1000, 2),
+        "ttfa_p50_ms": round(percentile(results.ttfa, 0.50) * 1000, 2),
+        "ttfa_p99_ms": round(percentile(results.ttfa, 0.99) * 1000, 2),
+        "turns_per_second": round(results.turns / wall, 2),
+        "frames_per_second": round(results.frames_received / wall, 1),
+        "received_mbytes_per_second": round(results.bytes_received / wall / 1e6, 3),
+        "backend_cpu_seconds": round(cpu, 3),
+        "backend_cpu_ms_per_session": round(cpu / sessions * 1000, 2),
+        "backend_cpu_ms_per_turn": round(cpu / max(results.turns, 1) * 1000, 3),
+        "backend_peak_rss_mb": round(peak_rss / 1e6, 1),
+        "backend_rss_kb_per_session": round((peak_rss - baseline_rss) / max(results.max_concurrent, 1) / 1000, 1),
+        "mock_responses": mock.responses,
+        "mock_connections": mock.connections,
+    }
+    width = max(len(key) for key in summary)
+    for key, value in summary.items():
+        print(f"{key:<{width}}  {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "results": summary}, f, indent=2)
+    return summary
+
+
+async def run(args):
+    mix = parse_mix(args.mix)
+    payloads = build_payloads(args, mix)
+    mock = MockRealtime(args.first_delta_ms, args.response_ms, args.chunk_ms, args.delta_interval_ms)
+    mock_server = await websockets.serve(mock.handle, "127.0.0.1", 0, max_size=None)
+    mock_url = f"ws://127.0.0.1:{mock_server.sockets[0].getsockname()[1]}"
+
+    process, port, config_path = start_backend(args, mock_url)
+    try:
+        await wait_for_port(port)
+        sampler = ProcessSampler(process.pid)
+        baseline_rss = sampler.rss_bytes()
+        sampling = asyncio.create_task(sampler.run())
+        results = Results()
+        cpu_started, started = sampler.cpu_seconds(), time.perf_counter()
+        await asyncio.gather(*(
+            run_session(args, f"ws://127.0.0.1:{port}", mix, payloads, results, args.ramp * i / args.sessions)
+            for i in range(args.sessions)
+        ))
+        wall = time.perf_counter() - started
+        cpu = sampler.cpu_seconds() - cpu_started
+        sampling.cancel()
+        return report(args, results, wall, cpu, baseline_rss, sampler.peak_rss, mock)
+    finally:
+        process.terminate()
+        # Waited for in a thread: the backend closes its upstream sockets on the mock, served by this loop
+        try:
+            await asyncio.to_thread(process.wait, 10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        mock_server.close()
+        os.unlink(config_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the realtime relay against a mock OpenAI server")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent frontend sessions")
+    parser.add_argument("--turns", type=int, default=3, help="turns per session")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which sessions are started")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between turns of a session")
+    parser.add_argument("--mix", default="text=1,wav=1",
+                        help="weights of input kinds: text, wav, pcm, webm (needs --webm-file, not with pcm)")
+    parser.add_argument("--input-seconds", type=float, default=1.0, help="length of synthetic audio input")
+    parser.add_argument("--webm-file", help="WebM/Opus recording sent for webm turns")
+    parser.add_argument("--audio-output-mode", choices=("stream", "wav"), default="stream")
+    parser.add_argument("--first-delta-ms", type=float, default=0, help="simulated model latency before the first delta")
+    parser.add_argument("--response-ms", type=float, default=2000, help="audio duration of each mock reply")
+    parser.add_argument("--chunk-ms", type=float, default=100, help="audio duration of each response.audio.delta")
+    parser.add_argument("--delta-interval-ms", type=float, default=5, help="pause between mock deltas")
+    parser.add_argument("--turn-timeout", type=float, default=30)
+    parser.add_argument("--upstream-pool-size", type=int, default=0,
+                        help="pre-connected upstream sessions kept by the backend (0 connects per session)")
+    parser.add_argument("--pool-interval", type=float, default=1,
+                        help="seconds between the backend's pool maintenance passes (UPSTREAM_POOL_PING_INTERVAL)")
+    parser.add_argument("--redis", help="Redis URL for the backend; an in-memory fake Redis is used by default")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--serve-backend", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    parser.add_argument("--fake-redis", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_backend:
+        serve_backend(args.serve_backend, args.fake_redis)
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
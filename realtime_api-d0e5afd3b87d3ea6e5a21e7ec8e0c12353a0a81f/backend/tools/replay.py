@@ -0,0 +1,299 @@
+# tools/replay.py
+# Replays a session recording (recorder.py) through the relay to profile it offline. The
+# recorded browser frames and OpenAI messages are fed to the same reader, handler and writer
+# code that chat_stream runs, at the original pace or faster. Frames are delivered in their
+# recorded order, so the replay is deterministic whatever the speed. What the relay sends is
+# counted and compared with what it sent when the session was recorded.
+#
+# Run from the backend directory:
+#   python -m tools.replay recordings/organization1/20261018T101438.256791-r1.rec
+#   python -m tools.replay session.rec --speed 0 --repeat 20 --profile cprofile --profile-output replay.prof
+#   python -m tools.replay session.rec --speed 1 --slow-callback-ms 20
+# --speed 0 replays as fast as the relay can go. Conversation history is kept in memory, not Redis,
+# and audio deltas are rebuilt from the raw audio, so base64 encoding of the replay shows up in profiles.
+import json
+import time
+import base64
+import asyncio
+import logging
+import argparse
+import cProfile
+import pstats
+import tracemalloc
+from starlette.websockets import WebSocketState
+from audio import audio_input_from_query
+from config import parse_config
+from event_log import SessionLog
+from metrics import EVENT_HANDLING_SECONDS, SessionMetrics
+from protocol import framing_for
+from recorder import read_recording
+from relay import create_senders, run_relay
+from transcoding import create_transcode_pool
+import main
+
+INPUT_STREAMS = ("client.text", "client.bytes", "openai", "openai.audio")
+
+
+def load_session(path):
+    # (session metadata, [(seconds, stream, payload)] of the frames to feed, {stream: (frames, bytes)} sent)
+    session, inputs, sent = None, [], {}
+    for seconds, stream, payload in read_recording(path):
+        if stream == "session":
+            session = json.loads(payload)
+        elif stream in INPUT_STREAMS:
+            inputs.append((seconds, stream, payload))
+        else:
+            frames, size = sent.get(stream, (0, 0))
+            sent[stream] = (frames + 1, size + len(payload))
+    if session is None:
+        raise SystemExit(f"{path} is not a session recording")
+    return session, inputs, sent
+
+
+def openai_message(stream, payload):
+    if stream == "openai.audio":
+        # Recorded as raw audio; rebuilt the way OpenAI sends it
+        audio = base64.b64encode(payload).decode("ascii")
+        return f'{{"type":"response.audio.delta","event_id":"event_replay","response_id":"resp_replay","item_id":"item_replay","output_index":0,"content_index":0,"delta":"{audio}"}}'
+    return payload.decode("utf-8")
+
+
+class Timeline:
+    # Hands out the recorded frames in order: a frame is delivered once every earlier frame was
+    # consumed, and (at speed > 0) no earlier than its recorded time divided by the speed
+    def __init__(self, inputs, speed):
+        self.inputs = inputs
+        self.speed = speed
+        self.position = 0
+        self._advanced = asyncio.Condition()
+        self._started = time.monotonic()
+
+    async def take(self, index):
+        seconds, stream, payload = self.inputs[index]
+        if self.speed > 0:
+            delay = self._started + seconds / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        async with self._advanced:
+            await self._advanced.wait_for(lambda: self.position == index)
+        return stream, payload
+
+    async def done(self, index):
+        async with self._advanced:
+            self.position = index + 1
+            self._advanced.notify_all()
+
+    async def finished(self):
+        async with self._advanced:
+            await self._advanced.wait_for(lambda: self.position == len(self.inputs))
+
+
+class ReplayFrontend:
+    # Stands in for the browser websocket: receives the recorded client frames, counts what is sent
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.indexes = [i for i, (_, stream, _) in enumerate(timeline.inputs) if stream.startswith("client.")]
+        self.client_state = WebSocketState.CONNECTED
+        self.sent = {"out.text": [0, 0], "out.bytes": [0, 0]}
+
+    async def receive(self):
+        if not self.indexes:
+            # The session ends from the OpenAI side, once everything was fed
+            await asyncio.Future()
+        index = self.indexes.pop(0)
+        stream, payload = await self.timeline.take(index)
+        message = {"type": "websocket.receive", "bytes": payload} if stream == "client.bytes" \
+            else {"type": "websocket.receive", "text": payload.decode("utf-8")}
+        await self.timeline.done(index)
+        return message
+
+    async def send_text(self, data):
+        self.sent["out.text"][0] += 1
+        self.sent["out.text"][1] += len(data.encode("utf-8"))
+
+    async def send_bytes(self, data):
+        self.sent["out.bytes"][0] += 1
+        self.sent["out.bytes"][1] += len(data)
+
+
+class ReplayUpstream:
+    # Stands in for the OpenAI connection: yields the recorded messages, counts what is sent
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.indexes = [i for i, (_, stream, _) in enumerate(timeline.inputs) if stream.startswith("openai")]
+        self.sent = {"upstream": [0, 0]}
+
+    async def send(self, message):
+        self.sent["upstream"][0] += 1
+        self.sent["upstream"][1] += len(message)
+
+    async def __aiter__(self):
+        for index in self.indexes:
+            stream, payload = await self.timeline.take(index)
+            message = openai_message(stream, payload)
+            await self.timeline.done(index)
+            yield message
+        await self.timeline.finished()
+
+
+class ReplayStore:
+    # Conversation history in memory, with the interface of storage.ConversationStore used by the relay
+    def __init__(self):
+        self.messages = []
+
+    def append(self, organization, request_id, message, item_id=None):
+        self.messages.append(message)
+
+    async def flush_conversation(self, organization, request_id, timeout=None):
+        return True
+
+    async def load(self, organization, request_id):
+        return {"messages": list(self.messages)}
+
+    async def load_page(self, organization, request_id, cursor, limit):
+        return {"messages": self.messages[cursor:cursor + limit] if limit else self.messages[cursor:]}
+
+
+async def replay_once(session, inputs, speed):
+    organization = session["organization"]
+    org_config = parse_config({organization: session["settings"]})[organization]
+    query = session.get("query", {})
+    audio_input = audio_input_from_query(query)
+    framing = framing_for(query, org_config.settings)
+
+    timeline = Timeline(inputs, speed)
+    frontend, upstream = ReplayFrontend(timeline), ReplayUpstream(timeline)
+    client_out, upstream_out = create_senders(frontend, upstream, framing)
+    with SessionMetrics(organization) as session_metrics:
+        session_log = SessionLog(organization, session["request_id"])
+        await run_relay(
+            main.handle_frontend_to_openai(
+                frontend, upstream_out, client_out, organization, session["request_id"], org_config,
+                session_log, session_metrics, audio_input, framing,
+            ),
+            main.handle_openai_to_frontend(
+                client_out, upstream, upstream_out, organization, session["request_id"], org_config,
+                session_log, session_metrics,
+            ),
+            client_out,
+            upstream_out,
+            drain_timeout=60,
+        )
+    return {**frontend.sent, **upstream.sent}
+
+
+def event_timings():
+    # {(direction, event type): (count, seconds)} from the relay's own event handling histogram
+    totals = {}
+    for metric in EVENT_HANDLING_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith(("_count", "_sum")):
+                key = (sample.labels["direction"], sample.labels["event_type"])
+                count, seconds = totals.get(key, (0, 0.0))
+                if sample.name.endswith("_count"):
+                    totals[key] = (count + sample.value, seconds)
+                else:
+                    totals[key] = (count, seconds + sample.value)
+    return totals
+
+
+async def replay(args, session, inputs):
+    main.store = ReplayStore()
+    main.transcode_pool = create_transcode_pool()
+    loop = asyncio.get_running_loop()
+    if args.slow_callback_ms:
+        # asyncio logs every callback that blocks the loop for longer than this
+        loop.set_debug(True)
+        loop.slow_callback_duration = args.slow_callback_ms / 1000
+    try:
+        results = []
+        for _ in range(args.repeat):
+            main.store.messages.clear()
+            started, cpu = time.perf_counter(), time.process_time()
+            sent = await replay_once(session, inputs, args.speed)
+            results.append((time.perf_counter() - started, time.process_time() - cpu, sent))
+        return results
+    finally:
+        main.transcode_pool.shutdown()
+
+
+def report(session, inputs, recorded, results, timings_before):
+    duration = inputs[-1][0] if inputs else 0.0
+    print(f"Session {session['organization']}:{session['request_id']} started {session['started']}, "
+          f"{len(inputs)} frames fed over {duration:.2f}s")
+    for run, (wall, cpu, _) in enumerate(results, 1):
+        print(f"  run {run}: {wall:.3f}s wall, {cpu:.3f}s CPU, {len(inputs) / cpu if cpu else float('inf'):,.0f} frames/cpu-s")
+
+    # Outbound traffic of the last run next to the recording
+    _, _, sent = results[-1]
+    print("Sent (recorded -> replayed):")
+    for stream in ("out.text", "out.bytes"):
+        before, (frames, size) = recorded.get(stream, (0, 0)), sent[stream]
+        print(f"  {stream:<10} {before[0]:>6} frames {before[1]:>10} bytes  ->  {frames:>6} frames {size:>10} bytes")
+    # Appends were recorded as decoded audio, so only the message counts compare
+    before = recorded.get("upstream", (0, 0))[0] + recorded.get("upstream.audio", (0, 0))[0]
+    print(f"  {'upstream':<10} {before:>6} messages  ->  {sent['upstream'][0]:>6} messages")
+
+    print("Event handling, all runs (count, total ms, mean us):")
+    timings = event_timings()
+    rows = []
+    for key, (count, seconds) in timings.items():
+        count_before, seconds_before = timings_before.get(key, (0, 0.0))
+        count, seconds = count - count_before, seconds - seconds_before
+        if count:
+            rows.append((seconds, key, count))
+    for seconds, (direction, event_type), count in sorted(rows, reverse=True):
+        print(f"  {direction:>6} {event_type:<40} {count:>8.0f} {seconds * 1000:>10.1f} {seconds / count * 1e6:>10.1f}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Replay a recorded session through the relay")
+    parser.add_argument("recording", help="file written by the session recorder (RECORDING_DIR)")
+    parser.add_argument("--speed", type=float, default=1.0, help="pace relative to the recording; 0 for as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the session this many times")
+    parser.add_argument("--profile", choices=("none", "cprofile", "tracemalloc"), default="none")
+    parser.add_argument("--profile-output", help="write the cProfile stats to this file (for pstats, snakeviz, ...)")
+    parser.add_argument("--profile-top", type=int, default=30, help="entries of the profile to print")
+    parser.add_argument("--profile-sort", choices=("tottime", "cumulative", "ncalls"), default="tottime",
+                        help="order of the printed cProfile entries")
+    parser.add_argument("--slow-callback-ms", type=float, default=0, help="log callbacks that block the event loop this long")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    # Importing main already configured logging, so the level is set directly: per-response INFO
+    # logs of the relay would dominate a fast replay
+    level = logging.INFO if args.verbose else logging.WARNING
+    logging.getLogger().setLevel(level)
+    logging.getLogger("relay").setLevel(level)
+
+    session, inputs, recorded = load_session(args.recording)
+    timings_before = event_timings()
+    profiler = cProfile.Profile() if args.profile == "cprofile" else None
+    if args.profile == "tracemalloc":
+        tracemalloc.start(25)
+    if profiler:
+        profiler.enable()
+    try:
+        results = asyncio.run(replay(args, session, inputs))
+    finally:
+        if profiler:
+            profiler.disable()
+    report(session, inputs, recorded, results, timings_before)
+
+    if profiler:
+        if args.profile_output:
+            profiler.dump_stats(args.profile_output)
+            print(f"cProfile stats written to {args.profile_output}")
+        print(f"Top {args.profile_top} functions by {args.profile_sort}:")
+        pstats.Stats(profiler).sort_stats(args.profile_sort).print_stats(args.profile_top)
+    if args.profile == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Memory: {current / 1024:.0f} KiB still allocated, {peak / 1024:.0f} KiB peak")
+        print(f"Top {args.profile_top} allocation sites:")
+        for stat in snapshot.statistics("lineno")[:args.profile_top]:
+            print(f"  {stat}")
+
+
+if __name__ == "__main__":
+    run()
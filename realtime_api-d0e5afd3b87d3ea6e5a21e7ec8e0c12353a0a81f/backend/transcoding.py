@@ -0,0 +1,123 @@
+# transcoding.py
+# Runs audio transcoding (pydub/ffmpeg) in a bounded worker pool so it never blocks the event loop
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from audio import process_audio
+from metrics import TRANSCODE_QUEUE_WAIT_SECONDS, TRANSCODE_SECONDS, TRANSCODE_REJECTED
+
+
+class TranscodeOverloaded(Exception):
+    """Raised when the transcoding queue is full and a new job is rejected."""
+
+
+def _timed_process_audio(raw_audio):
+    # Runs inside the worker; time.monotonic is system-wide so it is comparable across processes
+    started = time.monotonic()
+    result = process_audio(raw_audio)
+    return result, started, time.monotonic()
+
+
+class TranscodePool:
+    def __init__(self, max_workers=None, max_queue=32, executor="thread", default_org_concurrency=2, max_org_queue=4):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        # Number of jobs allowed to wait for a free worker before new uploads are rejected
+        self.max_queue = max_queue
+        self.executor_type = executor
+        self.default_org_concurrency = default_org_concurrency
+        # Jobs of one organization allowed to wait for its own concurrency limit, so a single busy
+        # organization cannot take the whole shared queue
+        self.max_org_queue = max_org_queue
+        self._executor = None
+        self._pending = 0
+        self._org_pending = {}  # organization -> jobs running or waiting
+        self._org_semaphores = {}
+        self.stats = {
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "queue_wait_seconds_total": 0.0,
+            "transcode_seconds_total": 0.0,
+        }
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="transcode")
+        return self._executor
+
+    def _org_semaphore(self, organization, concurrency):
+        # (semaphore, its concurrency); the first job of an organization sets the limit
+        entry = self._org_semaphores.get(organization)
+        if entry is None:
+            limit = concurrency or self.default_org_concurrency
+            entry = (asyncio.Semaphore(limit), limit)
+            self._org_semaphores[organization] = entry
+        return entry
+
+    def _reject(self, message):
+        self.stats["rejected"] += 1
+        TRANSCODE_REJECTED.inc()
+        raise TranscodeOverloaded(message)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def transcode(self, organization, raw_audio, concurrency=None):
+        # Returns (base64 PCM16 audio, timings) where timings holds queue wait and transcode seconds
+        semaphore, limit = self._org_semaphore(organization, concurrency)
+        org_pending = self._org_pending.get(organization, 0)
+        # Checked first, so an organization over its own limit does not use up shared queue space
+        if org_pending >= limit + self.max_org_queue:
+            self._reject(f"Too many uploads of this organization are being transcoded ({org_pending} pending), please retry shortly.")
+        if self._pending >= self.max_workers + self.max_queue:
+            self._reject(f"Audio transcoding queue is full ({self._pending} jobs pending), please retry shortly.")
+
+        self._pending += 1
+        self._org_pending[organization] = org_pending + 1
+        submitted = time.monotonic()
+        try:
+            async with semaphore:
+                loop = asyncio.get_running_loop()
+                result, started, finished = await loop.run_in_executor(
+                    self._get_executor(), _timed_process_audio, raw_audio
+                )
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self._pending -= 1
+            self._org_pending[organization] -= 1
+            if not self._org_pending[organization]:
+                del self._org_pending[organization]
+
+        timings = {"queue_wait": started - submitted, "transcode": finished - started}
+        self.stats["completed"] += 1
+        self.stats["queue_wait_seconds_total"] += timings["queue_wait"]
+        self.stats["transcode_seconds_total"] += timings["transcode"]
+        TRANSCODE_QUEUE_WAIT_SECONDS.observe(timings["queue_wait"])
+        TRANSCODE_SECONDS.observe(timings["transcode"])
+        return result, timings
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logging.info("Transcoding pool shut down.")
+
+
+def create_transcode_pool():
+    # Pool settings come from the environment so they can be tuned per deployment
+    workers = os.getenv("TRANSCODE_WORKERS")
+    return TranscodePool(
+        max_workers=int(workers) if workers else None,
+        max_queue=int(os.getenv("TRANSCODE_QUEUE_SIZE", "32")),
+        executor=os.getenv("TRANSCODE_EXECUTOR", "thread"),
+        default_org_concurrency=int(os.getenv("TRANSCODE_ORG_CONCURRENCY", "2")),
+        max_org_queue=int(os.getenv("TRANSCODE_ORG_QUEUE_SIZE", "4")),
+    )
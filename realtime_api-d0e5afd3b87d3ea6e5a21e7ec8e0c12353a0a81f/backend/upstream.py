@@ -0,0 +1,158 @@
+# upstream.py
+# Connections to the OpenAI Realtime API, with an optional per-organization pool of
+# pre-connected sessions that already received their session.update
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from websockets.client import connect
+
+
+class PooledSession:
+    def __init__(self, ws, session_update):
+        self.ws = ws
+        self.session_update = session_update  # payload the session was configured with
+        self.idle_since = time.monotonic()
+
+
+class UpstreamPool:
+    def __init__(self, url, headers, max_idle_seconds=300, ping_interval=20, ping_timeout=10, connect_timeout=10, close_timeout=2):
+        self.url = url
+        self.headers = headers
+        self.max_idle_seconds = max_idle_seconds
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.connect_timeout = connect_timeout
+        # Also bounds the cleanup after a failed handshake, which otherwise takes websockets' default 10s
+        self.close_timeout = close_timeout
+        self._idle = {}  # organization -> deque of PooledSession
+        self._warming = {}  # organization -> number of sessions being opened
+        self._closing = set()  # close handshakes of evicted sessions, so acquire() does not wait for them
+        self.stats = {"hits": 0, "misses": 0, "reused": 0, "evicted": 0}
+
+    async def _connect(self):
+        connecting = connect(
+            self.url, extra_headers=self.headers, open_timeout=self.connect_timeout, close_timeout=self.close_timeout,
+        )
+        return await asyncio.wait_for(connecting, self.connect_timeout)
+
+    async def open_session(self, org_config):
+        # Fresh connection configured for the organization; waits for session.updated so
+        # the session is ready for use once it sits in the pool
+        ws = await self._connect()
+        try:
+            await ws.send(org_config.session_update)
+            while True:
+                event = json.loads(await asyncio.wait_for(ws.recv(), self.connect_timeout))
+                if event.get('type') == 'session.updated':
+                    return ws
+                if event.get('type') == 'error':
+                    raise ConnectionError(f"Session setup failed: {event.get('error', {}).get('message')}")
+        except BaseException:
+            await ws.close()
+            raise
+
+    async def acquire(self, org_config):
+        # Hand out a warm session when one matches the organization's current config,
+        # otherwise connect and send session.update the usual way
+        idle = self._idle.get(org_config.name)
+        while idle:
+            session = idle.popleft()
+            if session.session_update == org_config.session_update and not session.ws.closed:
+                self.stats["hits"] += 1
+                logging.info(f"Using pre-connected OpenAI session for {org_config.name}")
+                return session.ws
+            self.stats["evicted"] += 1
+            task = asyncio.create_task(session.ws.close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+        self.stats["misses"] += 1
+        ws = await self._connect()
+        logging.info("Connected to OpenAI Realtime API")
+        try:
+            # Send session configuration
+            await ws.send(org_config.session_update)
+        except BaseException:
+            await ws.close()
+            raise
+        return ws
+
+    async def release(self, org_config, ws, reusable=False):
+        # A session is only put back when the client never sent anything upstream; anything
+        # else carries conversation state and is recycled (closed and replaced by a fresh one)
+        pool_size = org_config.settings.get("upstream_pool_size", 0)
+        idle = self._idle.setdefault(org_config.name, deque())
+        if reusable and not ws.closed and len(idle) < pool_size:
+            idle.append(PooledSession(ws, org_config.session_update))
+            self.stats["reused"] += 1
+            return
+        await ws.close()
+
+    async def _ping(self, session):
+        try:
+            pong = await session.ws.ping()
+            await asyncio.wait_for(pong, self.ping_timeout)
+            return True
+        except Exception:
+            return False
+
+    async def _warm(self, org_config):
+        self._warming[org_config.name] = self._warming.get(org_config.name, 0) + 1
+        try:
+            ws = await self.open_session(org_config)
+            self._idle.setdefault(org_config.name, deque()).append(PooledSession(ws, org_config.session_update))
+        except Exception as e:
+            logging.warning(f"Failed to pre-connect OpenAI session for {org_config.name}: {e}")
+        finally:
+            self._warming[org_config.name] -= 1
+
+    async def maintain(self, organizations):
+        # One maintenance pass: drop closed, stale-config and idle-expired sessions, ping the
+        # rest and top every organization up to its upstream_pool_size
+        now = time.monotonic()
+        warmups = []
+        for org_config in organizations:
+            idle = self._idle.setdefault(org_config.name, deque())
+            # Iterate over a copy: acquire() may hand sessions out while a ping is in flight
+            for session in list(idle):
+                expired = now - session.idle_since > self.max_idle_seconds
+                stale = session.session_update != org_config.session_update
+                if session.ws.closed or expired or stale or not await self._ping(session):
+                    if session in idle:
+                        idle.remove(session)
+                        self.stats["evicted"] += 1
+                        await session.ws.close()
+
+            missing = org_config.settings.get("upstream_pool_size", 0) - len(idle) - self._warming.get(org_config.name, 0)
+            warmups.extend(self._warm(org_config) for _ in range(max(missing, 0)))
+
+        # Organizations removed from the config lose their pooled sessions
+        names = {org_config.name for org_config in organizations}
+        for name in [name for name in self._idle if name not in names]:
+            for session in self._idle.pop(name):
+                await session.ws.close()
+
+        if warmups:
+            await asyncio.gather(*warmups)
+
+    async def run(self, get_organizations):
+        while True:
+            try:
+                await self.maintain(get_organizations())
+            except Exception as e:
+                logging.error(f"Upstream pool maintenance failed: {e}")
+            await asyncio.sleep(self.ping_interval)
+
+    def idle_count(self, organization):
+        return len(self._idle.get(organization, ()))
+
+    async def close(self):
+        # Popped one at a time: a warm-up finishing meanwhile may still append to the deques
+        for idle in list(self._idle.values()):
+            while idle:
+                await idle.popleft().ws.close()
+        self._idle.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)